@@ -0,0 +1,457 @@
+import json
+import os
+import shutil
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from prompt import *
+import sandbox
+import table_compaction
+import tracing
+from output_store import OutputStore, scan_output
+from trace_store import TraceStore, get_trace_store_path
+from openai_utils import get_completion, get_function_completion, route_model
+from run_llm import (
+    build_arg_parser,
+    configure_pipeline,
+    load_test_data,
+    select_test_data,
+    get_output_path,
+    print_run_stats,
+    extract_function_info,
+    bind_arguments_locally,
+    run_function,
+    merge_partial_answers,
+    normalize_question,
+    json_serialize_safe,
+)
+
+
+class BatchPending(Exception):
+    '''
+    Raised in offline mode once a stage's batch input file is written and its results are not available yet
+    '''
+
+
+def unwrap(response):
+    '''
+    A response returned by StageBackend, re-raising the error if its request failed
+    '''
+    if isinstance(response, Exception):
+        raise response
+    return response
+
+
+def call_or_error(fn, *args, **kwargs):
+    # Errors are returned per request so that they fail only the example that sent it
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        return e
+
+
+class StageBackend:
+    '''
+    Sends all requests of one pipeline stage together.
+
+    "online": the requests go out concurrently through get_completion/get_function_completion
+    (cache and rate limits included), so an OpenAI-compatible server such as vLLM can batch them.
+    "offline": the requests are written to <batch_dir>/<stage>.input.jsonl in OpenAI Batch API
+    format and the run stops; once the results are saved as <batch_dir>/<stage>.output.jsonl,
+    re-running resumes from that stage.
+
+    A request that fails yields its exception in place of the response; read responses
+    with unwrap().
+    '''
+    def __init__(self, model, mode="online", concurrency=64, batch_dir=None):
+        if mode not in ("online", "offline"):
+            raise ValueError(f"Unknown batch mode: {mode}")
+        if mode == "offline" and not batch_dir:
+            raise ValueError("Offline batch mode needs a batch directory")
+        self.model = model
+        self.mode = mode
+        self.concurrency = concurrency
+        self.batch_dir = batch_dir
+
+    def complete(self, stage, requests):
+        '''
+        requests: list of (custom_id, messages); returns {custom_id: content, or the error of a failed request}
+        '''
+        if not requests:
+            return {}
+        if self.mode == "offline":
+            model = route_model(stage.split(".")[-1], self.model)
+            bodies = [(custom_id, {"model": model, "messages": messages, "temperature": 0.7}) for custom_id, messages in requests]
+            return {custom_id: message if isinstance(message, Exception) else message.get("content") for custom_id, message in self._offline(stage, bodies).items()}
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(requests))) as executor:
+            contents = executor.map(lambda request: call_or_error(get_completion, request[1], self.model, stage=stage.split(".")[-1]), requests)
+            return {custom_id: content for (custom_id, _), content in zip(requests, contents)}
+
+    def complete_tools(self, stage, requests):
+        '''
+        requests: list of (custom_id, messages, tools); returns {custom_id: arguments JSON string, None, or the error of a failed request}
+        '''
+        if not requests:
+            return {}
+        if self.mode == "offline":
+            model = route_model("argument_binding", self.model)
+            bodies = [(custom_id, {"model": model, "messages": messages, "tools": tools, "tool_choice": "auto"}) for custom_id, messages, tools in requests]
+            arguments = {}
+            for custom_id, message in self._offline(stage, bodies).items():
+                if isinstance(message, Exception):
+                    arguments[custom_id] = message
+                    continue
+                tool_calls = message.get("tool_calls")
+                arguments[custom_id] = tool_calls[0]["function"]["arguments"] if tool_calls else None
+            return arguments
+        def call(request):
+            tool_call = get_function_completion(request[1], functions=request[2], model=self.model)
+            return tool_call.function.arguments if tool_call is not None else None
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(requests))) as executor:
+            results = executor.map(lambda request: call_or_error(call, request), requests)
+            return {custom_id: arguments for (custom_id, _, _), arguments in zip(requests, results)}
+
+    def _offline(self, stage, bodies):
+        os.makedirs(self.batch_dir, exist_ok=True)
+        input_path = os.path.join(self.batch_dir, f"{stage}.input.jsonl")
+        output_path = os.path.join(self.batch_dir, f"{stage}.output.jsonl")
+        if not os.path.exists(output_path):
+            with open(input_path, "w", encoding="utf-8") as f:
+                for custom_id, body in bodies:
+                    f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}, ensure_ascii=False) + "\n")
+            raise BatchPending(f"Submit {input_path} and save the results as {output_path}, then re-run to continue")
+        messages = {}
+        with open(output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code", 200) != 200:
+                    messages[record["custom_id"]] = RuntimeError(f"Batch request failed: {record.get('error') or response.get('body')}")
+                    continue
+                choices = (response.get("body") or {}).get("choices") or [{}]
+                messages[record["custom_id"]] = choices[0].get("message") or {}
+        missing = [custom_id for custom_id, _ in bodies if custom_id not in messages]
+        if missing:
+            # The Batch API writes failed requests to a separate error file; both are needed
+            raise BatchPending(f"{output_path} has no result for {len(missing)} of {len(bodies)} requests, e.g. {missing[0]}; "
+                               f"append the records of the batch error file to it, then re-run to continue")
+        return {custom_id: messages[custom_id] for custom_id, _ in bodies}
+
+
+class BatchEngine:
+    '''
+    Breadth-first version of run_llm.process_example.
+
+    Every stage (plan_generation, check_plan, function_generator, ...) runs for all pending
+    examples before the next one starts, so each stage can be sent as a single batch. The
+    state of all examples is checkpointed after every stage, and a re-run resumes after the
+    last completed one.
+    '''
+    def __init__(self, items, model, dataset_name, backend, checkpoint_path):
+        self.model = model
+        self.dataset_name = dataset_name
+        self.backend = backend
+        self.checkpoint_path = checkpoint_path
+        self.tables = {item["example_id"]: item["table"] for item in items}
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            self.completed = checkpoint["completed"]
+            self.states = checkpoint["states"]
+            print(f"Resuming batch run after stage {self.completed[-1] if self.completed else '(none)'}")
+        else:
+            self.completed = []
+            self.states = [{
+                "example_id": item["example_id"],
+                "query": item["query"],
+                "ground_truth": item["summary"],
+                "old_plan": None,
+                "done": False,
+                "ready": False,
+                "error": None,
+                "prediction": None,
+                "log_data": [],
+                "answers": {},
+                "arguments": {},
+                "subs": [],
+            } for item in items]
+            # Saved right away so that an offline run stopping at its first stage resumes with the same examples
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"completed": self.completed, "states": json_serialize_safe(self.states)}, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def step(self, name, fn):
+        if name in self.completed:
+            return
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Stage {name}...")
+        with tracing.span(name, "stage", examples=len(self.active())):
+            fn(name)
+        self.completed.append(name)
+        self.save()
+
+    def active(self):
+        return [state for state in self.states if not state["error"] and not state["ready"]]
+
+    def pending_subs(self, predicate=lambda sub: True):
+        return [(state, sub) for state in self.active() for sub in state["subs"] if not sub["reused"] and predicate(sub)]
+
+    def guard(self, state, fn, *args):
+        # A failure in one example marks only that example as an error
+        try:
+            fn(*args)
+        except Exception as e:
+            state["error"] = f"{type(e).__name__}: {e}"
+
+    # ---- stages ----
+
+    def plan_stage(self, name):
+        states = self.active()
+        responses = self.backend.complete(name, [(state["example_id"], plan_generation_messages(state["query"], state["old_plan"])) for state in states])
+        for state in states:
+            self.guard(state, lambda state=state: self._set_plan(state, unwrap(responses[state["example_id"]])))
+
+    def _set_plan(self, state, response):
+        plan = parse_plan(response)
+        state["old_plan"] = plan
+        state["subs"] = []
+        for question in plan:
+            reused = state["answers"].get(normalize_question(question))
+            state["subs"].append({
+                "question": question,
+                "reused": reused is not None,
+                "response": None,
+                "function": None,
+                "functions": [],
+                "success": False,
+                "result": None,
+                "feedback": None,
+                "executed": False,
+                "debug_rounds": 0,
+                "short_answer": None,
+                "long_answer": reused["long_answer"] if reused else None,
+                "log": dict(reused["log"], reused_from_iter=reused["iter_num"]) if reused else None,
+            })
+
+    def check_stage(self, name):
+        states = self.active()
+        responses = self.backend.complete(name, [(state["example_id"], check_plan_messages(state["query"], state["old_plan"])) for state in states])
+        for state in states:
+            def set_done(state=state):
+                state["done"] = parse_check(unwrap(responses[state["example_id"]]))
+            self.guard(state, set_done)
+
+    def function_generator_stage(self, name):
+        pairs = self.pending_subs()
+        requests = [(f"{state['example_id']}/{i}", function_generator_messages(sub["question"], self.tables[state["example_id"]])) for i, (state, sub) in enumerate(pairs)]
+        responses = self.backend.complete(name, requests)
+        for (custom_id, _), (state, sub) in zip(requests, pairs):
+            self.guard(state, self._set_response, sub, responses, custom_id)
+
+    def _set_response(self, sub, responses, custom_id):
+        sub["response"] = unwrap(responses[custom_id])
+
+    def extraction_stage(self, name):
+        # Local AST extraction first; only what does not parse goes to the extraction prompt
+        pairs = self.pending_subs(lambda sub: not sub["success"] and sub["response"] is not None)
+        requests = []
+        for i, (state, sub) in enumerate(pairs):
+            function = extract_function_locally(sub["response"])
+            if function:
+                extraction_stats["local"] += 1
+                self._set_function(sub, function)
+            else:
+                extraction_stats["fallback"] += 1
+                requests.append((f"{state['example_id']}/{i}", function_extraction_messages(sub["response"]), state, sub))
+        responses = self.backend.complete(name, [(custom_id, messages) for custom_id, messages, _, _ in requests])
+        for custom_id, _, state, sub in requests:
+            self.guard(state, lambda: self._set_function(sub, parse_extracted_function(unwrap(responses[custom_id]))))
+
+    def _set_function(self, sub, function):
+        sub["function"] = function
+        sub["functions"].append(function)
+        sub["response"] = None
+
+    def execute_stage(self, name):
+        # Bind arguments (cached, local match, or one batched tool call), then run the functions
+        pairs = self.pending_subs(lambda sub: not sub["success"] and sub["function"] is not None and not sub["executed"])
+        calls = []
+        tool_requests = []
+        for i, (state, sub) in enumerate(pairs):
+            sub["executed"] = True
+            function, function_name, function_args = extract_function_info(sub["function"])
+            if not function:
+                sub["feedback"] = None
+                continue
+            key = json.dumps([sub["question"], function_args])
+            if function_args and key not in state["arguments"]:
+                arguments = bind_arguments_locally(sub["question"], self.tables[state["example_id"]], function_args)
+                if arguments is None:
+                    tool_requests.append((key + f"/{i}", [{"role": "user", "content": sub["question"]}], function))
+                    calls.append((state, sub, function_name, function_args, key, key + f"/{i}"))
+                    continue
+                state["arguments"][key] = arguments
+            calls.append((state, sub, function_name, function_args, key, None))
+        bound = self.backend.complete_tools(name + ".arguments", tool_requests)
+        for state, sub, function_name, function_args, key, custom_id in calls:
+            if state["error"]:
+                continue  # an earlier sub-question of this example failed in this stage
+            self.guard(state, self._execute, state, sub, function_name, function_args, key, bound, custom_id)
+
+    def _execute(self, state, sub, function_name, function_args, key, bound, custom_id):
+        if custom_id is not None:
+            bound_arguments = unwrap(bound[custom_id])
+            if bound_arguments is None:
+                sub["feedback"] = "Feedback: could not determine the function arguments from the question."
+                return
+            state["arguments"][key] = json.loads(bound_arguments)
+        arguments = state["arguments"].get(key, {})
+        sub["success"], sub["result"], sub["feedback"] = run_function(function_name, sub["function"], function_args, self.tables[state["example_id"]], arguments)
+
+    def self_debugging_stage(self, name):
+        pairs = self.pending_subs(lambda sub: not sub["success"] and sub["debug_rounds"] < 3)
+        requests = []
+        for i, (state, sub) in enumerate(pairs):
+            sub["debug_rounds"] += 1
+            sub["executed"] = False
+            messages = self_debugging_messages(sub["question"], self.tables[state["example_id"]], sub["function"], sub["feedback"])
+            requests.append((f"{state['example_id']}/{i}", messages))
+        responses = self.backend.complete(name, requests)
+        for (custom_id, _), (state, sub) in zip(requests, pairs):
+            self.guard(state, self._set_response, sub, responses, custom_id)
+
+    def ask_directly_stage(self, name):
+        pairs = self.pending_subs(lambda sub: sub["result"] is None or sub["result"] == "None")
+        requests = []
+        for i, (state, sub) in enumerate(pairs):
+            table_data = self.tables[state["example_id"]]
+            chunks = table_compaction.chunk_table(table_data) if table_compaction.is_oversized(table_data) else [table_data]
+            sub["chunk_ids"] = [f"{state['example_id']}/{i}/{j}" for j in range(len(chunks))]
+            requests += [(custom_id, ask_directly_messages(sub["question"], chunk)) for custom_id, chunk in zip(sub["chunk_ids"], chunks)]
+        responses = self.backend.complete(name, requests)
+        for state, sub in pairs:
+            self.guard(state, self._set_direct_answer, sub, responses)
+
+    def _set_direct_answer(self, sub, responses):
+        partial_answers = [unwrap(responses[custom_id]) for custom_id in sub.pop("chunk_ids")]
+        sub["result"] = partial_answers[0] if len(partial_answers) == 1 else merge_partial_answers(partial_answers)
+
+    def sentence_stage(self, name):
+        pairs = self.pending_subs()
+        requests = []
+        for i, (state, sub) in enumerate(pairs):
+            sub["short_answer"] = sub["result"]
+            requests.append((f"{state['example_id']}/{i}", sentence_generator_messages(sub["short_answer"], sub["question"])))
+        responses = self.backend.complete(name, requests)
+        for (custom_id, _), (state, sub) in zip(requests, pairs):
+            def set_long_answer(sub=sub, custom_id=custom_id):
+                sub["long_answer"] = unwrap(responses[custom_id])
+            self.guard(state, set_long_answer)
+
+    def finish_iteration(self, iter_num):
+        for state in self.active():
+            sub_log_list = []
+            for sub in state["subs"]:
+                if not sub["reused"]:
+                    sub["log"] = {"function": sub["functions"], "short_answer": sub["short_answer"], "long_answer": sub["long_answer"]}
+                    state["answers"].setdefault(normalize_question(sub["question"]), {"long_answer": sub["long_answer"], "log": sub["log"], "iter_num": iter_num})
+                sub_log_list.append(sub["log"])
+            state["answer_list"] = [sub["long_answer"] for sub in state["subs"]]
+            state["log_data"].append({"iter_num": iter_num, "plan": state["old_plan"], "reasoning_log": sub_log_list})
+            state["subs"] = []
+            if state["done"] or iter_num >= 3:
+                state["ready"] = True
+
+    def final_answer_stage(self, name):
+        states = [state for state in self.states if state["ready"] and not state["error"]]
+        if self.dataset_name == "FeTaQA":
+            build = generate_final_answer_fetaqa_messages
+        elif self.dataset_name == "QTSumm":
+            build = generate_final_answer_qtsumm_messages
+        else:
+            # run_llm.process_example writes "error" for unknown datasets as well
+            return
+        responses = self.backend.complete(name, [(state["example_id"], build(state["query"], state["answer_list"])) for state in states])
+        for state in states:
+            def set_prediction(state=state):
+                state["prediction"] = unwrap(responses[state["example_id"]])
+            self.guard(state, set_prediction)
+
+    def run(self):
+        for iter_num in range(1, 4):
+            prefix = f"iter{iter_num}"
+            self.step(f"{prefix}.plan_generation", self.plan_stage)
+            self.step(f"{prefix}.check_plan", self.check_stage)
+            self.step(f"{prefix}.function_generator", self.function_generator_stage)
+            self.step(f"{prefix}.function_extraction", self.extraction_stage)
+            self.step(f"{prefix}.execute", self.execute_stage)
+            for debug_round in range(1, 4):
+                self.step(f"{prefix}.debug{debug_round}.self_debugging", self.self_debugging_stage)
+                self.step(f"{prefix}.debug{debug_round}.function_extraction", self.extraction_stage)
+                self.step(f"{prefix}.debug{debug_round}.execute", self.execute_stage)
+            self.step(f"{prefix}.ask_directly", self.ask_directly_stage)
+            self.step(f"{prefix}.sentence_generator", self.sentence_stage)
+            self.step(f"{prefix}.finish", lambda name: self.finish_iteration(iter_num))
+        self.step("final_answer", self.final_answer_stage)
+
+    def results(self):
+        for state in self.states:
+            if state["error"] or state["prediction"] is None:
+                yield {"example_id": state["example_id"], "query": state["query"], "prediction": "error"}
+            else:
+                yield {"example_id": state["example_id"], "query": state["query"], "prediction": state["prediction"], "ground_truth": state["ground_truth"], "log_data": json_serialize_safe(state["log_data"])}
+
+
+if __name__ == "__main__":
+    parser = build_arg_parser()
+    parser.add_argument("--batch_mode", type=str, default="online", choices=["online", "offline"]) # offline writes Batch API JSONL files
+    parser.add_argument("--batch_concurrency", type=int, default=64) # in-flight requests per stage in online mode
+    parser.add_argument("--checkpoint_path", type=str, default=None) # defaults to <output file>.batch_checkpoint.json
+    args = parser.parse_args()
+    dataset_name = args.dataset_name.split("/")[-1]
+    output_path = get_output_path(args)
+    checkpoint_path = args.checkpoint_path or output_path + ".batch_checkpoint.json"
+    batch_dir = checkpoint_path + ".batches"
+
+    configure_pipeline(args)
+    done_samples, success_count, error_count = scan_output(output_path)
+    test_data, n_samples = select_test_data(load_test_data(args.dataset_name, args.split_name, args.dataset_cache_dir), args)
+
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            checkpoint_ids = {state["example_id"] for state in json.load(f)["states"]}
+        items = [item for item in test_data if item["example_id"] in checkpoint_ids]
+    else:
+        # Batch files of an earlier run belong to other requests
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        items = [item for item in test_data if item["example_id"] not in done_samples]
+        if n_samples != -1:
+            items = items[:n_samples]
+
+    print(f"Starting batch processing of {len(items)} samples, {success_count} samples completed...")
+    backend = StageBackend(args.model, args.batch_mode, args.batch_concurrency, batch_dir)
+    engine = BatchEngine(items, args.model, dataset_name, backend, checkpoint_path)
+    try:
+        engine.run()
+    except BatchPending as e:
+        print(f"Batch pending: {e}")
+    else:
+        with OutputStore(output_path) as store, (TraceStore(get_trace_store_path(output_path)) if args.separate_log_data else nullcontext()) as trace_store:
+            for result_item in engine.results():
+                if trace_store is not None and "log_data" in result_item:
+                    trace_store.put(result_item["example_id"], result_item.pop("log_data"))
+                store.append(result_item)
+        os.remove(checkpoint_path)
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        print("✓ All data processing completed!")
+    finally:
+        if sandbox.pool is not None:
+            sandbox.pool.close()
+        tracing.save()
+    print_run_stats()
@@ -0,0 +1,148 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak RSS is not reported there
+    resource = None
+
+import openai_utils
+import sandbox
+import tracing
+from mock_server import MockLLMServer, MODES, LATENCY_DISTRIBUTIONS
+from prompt import extraction_stats
+from run_llm import build_arg_parser, configure_pipeline, get_table_answer, load_test_data, argument_stats
+from trace_store import get_trace_store_path
+from usage_report import percentile, summarize_calls
+
+
+def load_examples(args):
+    '''
+    The fixed benchmark sample: the first n_samples examples of a JSONL file or of the dataset split
+    '''
+    if args.examples_file:
+        with open(args.examples_file, "r", encoding="utf-8") as f:
+            examples = [json.loads(line) for line in f if line.strip()]
+    else:
+        examples = load_test_data(args.dataset_name, args.split_name, args.dataset_cache_dir)
+    if args.n_samples != -1:
+        examples = [examples[i] for i in range(min(args.n_samples, len(examples)))]
+    return list(examples)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args, examples, dataset_name):
+    server = MockLLMServer(args.mock_mode, args.mock_cache_path, args.latency_ms, args.latency_jitter_ms,
+                           args.rate_429, args.rate_500, args.retry_after, args.seed,
+                           latency_distribution=args.latency_distribution, latency_sigma=args.latency_sigma)
+    openai_utils.configure_client(server.start(), api_key="benchmark")
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_path = os.path.join(output_dir, "output.jsonl")
+            # Checkpoints and the trace store cost what they cost in a real run, so they are kept on
+            checkpoint_dir = None if args.no_checkpoints else output_path + ".checkpoints"
+            trace_store_path = get_trace_store_path(output_path) if args.separate_log_data else None
+            start = time.monotonic()
+            get_table_answer(examples, set(), -1, args.model, output_path, dataset_name, args.concurrency, args.ordered,
+                             args.sub_question_concurrency, args.pipeline_plan_check, args.batch_sentences, checkpoint_dir, trace_store_path)
+            wall_time = time.monotonic() - start
+            with open(output_path, "r", encoding="utf-8") as f:
+                results = [json.loads(line) for line in f if line.strip()]
+    finally:
+        server.stop()
+
+    latencies = [result["elapsed"] for result in results]
+    calls = [call for result in results for call in result["llm_calls"]]
+    stages, _ = summarize_calls(calls)
+    return {
+        "examples": len(results),
+        "errors": sum(result["prediction"] == "error" for result in results),
+        "wall_time": round(wall_time, 3),
+        "examples_per_sec": round(len(results) / wall_time, 4) if wall_time else None,
+        "llm_calls_per_example": round(len(calls) / len(results), 3) if results else None,
+        "latency_p50": percentile(latencies, 50) if latencies else None,
+        "latency_p99": percentile(latencies, 99) if latencies else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+        "server": dict(server.stats),
+        "extraction": dict(extraction_stats),
+        "argument_binding": dict(argument_stats),
+    }
+
+
+def print_comparison(result, baseline):
+    print(f"{'Metric':<24}{'Baseline':>12}{'Current':>12}{'Change':>10}")
+    for key in ("examples_per_sec", "llm_calls_per_example", "latency_p50", "latency_p99", "peak_rss_mb"):
+        old, new = baseline.get(key), result.get(key)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else ""
+        print(f"{key:<24}{str(old):>12}{str(new):>12}{change:>10}")
+
+
+if __name__ == "__main__":
+    parser = build_arg_parser()
+    parser.add_argument("--examples_file", type=str, default=None) # JSONL of examples to use instead of downloading the dataset
+    parser.add_argument("--results_path", type=str, default="benchmark_results.json")
+    parser.add_argument("--baseline", type=str, default=None) # results JSON of an earlier commit to compare against
+    parser.add_argument("--mock_mode", type=str, default="synthetic", choices=MODES)
+    parser.add_argument("--mock_cache_path", type=str, default=None) # recording for --mock_mode replay/record
+    parser.add_argument("--latency_ms", type=float, default=200.0) # mock LLM latency per request
+    parser.add_argument("--latency_jitter_ms", type=float, default=0.0)
+    parser.add_argument("--latency_distribution", type=str, default="lognormal", choices=LATENCY_DISTRIBUTIONS)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--rate_429", type=float, default=0.0)
+    parser.add_argument("--rate_500", type=float, default=0.0)
+    parser.add_argument("--retry_after", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    # The sample is fixed and every request goes to the mock server
+    if args.endpoints:
+        parser.error("--endpoints would send requests past the mock server")
+    if args.num_shards > 1:
+        parser.error("--num_shards does not apply; use --n_samples or --examples_file to pick the sample")
+    dataset_name = args.dataset_name.split("/")[-1]
+
+    configure_pipeline(args)
+    examples = load_examples(args)
+    print(f"Benchmarking {len(examples)} {dataset_name} examples against a {args.mock_mode} mock LLM...")
+    try:
+        result = run_benchmark(args, examples, dataset_name)
+    finally:
+        if sandbox.pool is not None:
+            sandbox.pool.close()
+        if tracing.tracer is not None:
+            tracing.save()
+            print(f"Trace written to {args.trace_path}")
+
+    report = {"commit": git_commit(), "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "config": vars(args), **result}
+    os.makedirs(os.path.dirname(args.results_path) or ".", exist_ok=True)
+    with open(args.results_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{result['examples']} examples ({result['errors']} errors) in {result['wall_time']:.1f}s: {result['examples_per_sec']} examples/s")
+    print(f"LLM calls per example: {result['llm_calls_per_example']}, example latency p50 {result['latency_p50']}s / p99 {result['latency_p99']}s")
+    print(f"Peak RSS: {result['peak_rss_mb']} MB, mock server: {result['server']}")
+    for stage, stats in result["stages"].items():
+        print(f"  {stage:<22}{stats['calls']:>6} calls  p50 {stats['p50_latency']:.3f}s  p95 {stats['p95_latency']:.3f}s")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            print_comparison(result, json.load(f))
+    print(f"Results written to {args.results_path}")
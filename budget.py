@@ -0,0 +1,79 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Budget:
+    '''
+    Limits on the LLM calls, tokens and wall time spent under it; None means unlimited.
+    Only requests that reach the API are charged, cache hits are free.
+    '''
+    def __init__(self, max_calls=None, max_tokens=None, max_seconds=None):
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.start = time.monotonic()
+        self.calls = 0
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def charge(self, tokens):
+        with self.lock:
+            self.calls += 1
+            self.tokens += tokens
+
+    def exceeded(self):
+        '''
+        Name of the first exhausted limit ("calls", "tokens" or "time"), or None
+        '''
+        with self.lock:
+            if self.max_calls is not None and self.calls >= self.max_calls:
+                return "calls"
+            if self.max_tokens is not None and self.tokens >= self.max_tokens:
+                return "tokens"
+        if self.max_seconds is not None and time.monotonic() - self.start >= self.max_seconds:
+            return "time"
+        return None
+
+
+# Run-wide budget and the limits of each example's budget, set with configure_budgets
+run_budget = Budget()
+example_limits = {"max_calls": None, "max_tokens": None, "max_seconds": None}
+
+# Budget of the example being processed in this context
+_example_budget = contextvars.ContextVar("example_budget", default=None)
+
+def configure_budgets(example_calls=None, example_tokens=None, example_seconds=None, run_calls=None, run_tokens=None, run_seconds=None):
+    global run_budget
+    example_limits.update(max_calls=example_calls, max_tokens=example_tokens, max_seconds=example_seconds)
+    run_budget = Budget(run_calls, run_tokens, run_seconds)
+    return run_budget
+
+@contextmanager
+def example_budget():
+    '''
+    Charge the LLM calls of this context (and of thread pool work submitted from it) to a fresh per-example budget
+    '''
+    token = _example_budget.set(Budget(**example_limits))
+    try:
+        yield
+    finally:
+        _example_budget.reset(token)
+
+def charge(tokens):
+    run_budget.charge(tokens)
+    budget = _example_budget.get()
+    if budget is not None:
+        budget.charge(tokens)
+
+def exhausted():
+    '''
+    Which budget ran out, e.g. "example_tokens" or "run_time", or None while both have room left
+    '''
+    budget = _example_budget.get()
+    reason = budget.exceeded() if budget is not None else None
+    if reason is not None:
+        return f"example_{reason}"
+    reason = run_budget.exceeded()
+    return f"run_{reason}" if reason is not None else None
@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+from datasets import load_dataset, load_from_disk
+
+# Bump when the unified format or the transforms below change, so stale caches are rebuilt
+TRANSFORM_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join("cache", "datasets")
+
+UNIFIED_COLUMNS = ["example_id", "query", "summary", "table"]
+
+
+def transform_fetaqa_to_qtsumm(example):
+    table_dict = {
+        'header': example['table_array'][0],
+        'rows': example['table_array'][1:],
+        'title': f"{example['table_page_title']}, {example['table_section_title']}"
+    }
+    return {
+        'example_id': str(example['feta_id']),
+        'query': example['question'],
+        'summary': example['answer'],
+        'table': table_dict
+    }
+
+
+def get_cache_path(dataset_name, split_name, cache_dir=DEFAULT_CACHE_DIR):
+    name = re.sub(r"[^\w.-]", "_", f"{dataset_name}__{split_name}")
+    return os.path.join(cache_dir, f"{name}__v{TRANSFORM_VERSION}")
+
+
+class UnifiedDataset:
+    '''
+    A dataset split in the unified {example_id, query, summary, table} format, backed by a
+    memory-mapped Arrow cache. Examples are decoded only when they are accessed, and
+    example_id lookups go through an index stored next to the cache.
+    '''
+    def __init__(self, path):
+        self.dataset = load_from_disk(path)
+        with open(os.path.join(path, "example_index.json"), "r", encoding="utf-8") as f:
+            self.index = json.load(f)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        return iter(self.dataset)
+
+    def __getitem__(self, i):
+        return self.dataset[i]
+
+    def __contains__(self, example_id):
+        return str(example_id) in self.index
+
+    def example_ids(self):
+        '''
+        All example ids in dataset order, without decoding any example
+        '''
+        return list(self.index)
+
+    def get(self, example_id):
+        '''
+        The example with this id, or None
+        '''
+        i = self.index.get(str(example_id))
+        return self.dataset[i] if i is not None else None
+
+
+def build_cache(dataset_name, split_name, path):
+    data = load_dataset(dataset_name, split=split_name)
+    if dataset_name.split("/")[-1] == "FeTaQA":
+        data = data.map(transform_fetaqa_to_qtsumm, remove_columns=data.column_names)
+    data = data.select_columns(UNIFIED_COLUMNS)
+    # Written to a temporary directory of its own first, so an interrupted build never looks
+    # complete and concurrent builds of the same split (e.g. one per shard) do not collide
+    cache_dir = os.path.dirname(path) or "."
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(path) + ".tmp", dir=cache_dir)
+    try:
+        build_path = os.path.join(tmp_dir, "data")
+        data.save_to_disk(build_path)
+        with open(os.path.join(build_path, "example_index.json"), "w", encoding="utf-8") as f:
+            json.dump({str(example_id): i for i, example_id in enumerate(data["example_id"])}, f)
+        if not is_built(path):
+            try:
+                os.replace(build_path, path)
+            except OSError:
+                if not is_built(path):
+                    raise
+                # another process finished the same build first; its copy is kept
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def is_built(path):
+    return os.path.exists(os.path.join(path, "example_index.json"))
+
+
+def load_unified(dataset_name, split_name, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Load a QTSumm/FeTaQA split in the unified format, building its on-disk cache on first use
+    '''
+    path = get_cache_path(dataset_name, split_name, cache_dir)
+    if not is_built(path):
+        print(f"Building dataset cache {path}...")
+        build_cache(dataset_name, split_name, path)
+    return UnifiedDataset(path)
@@ -1,12 +1,13 @@
-import json
+import argparse
 import evaluate
 import nltk
 import torch
 from autoacu import A3CU
 from typing import List
 from nltk import word_tokenize
-from torch.utils.data import DataLoader
-from tapas_acc import TapasTest, MyData
+from tapas_acc import TapasTest, MyData, make_dataloader, DEFAULT_MAX_BATCH_TOKENS
+from output_store import read_results
+from dataset_cache import DEFAULT_CACHE_DIR
 import warnings
 
 warnings.filterwarnings("ignore", category=FutureWarning, module="transformers.models.tapas.tokenization_tapas")
@@ -14,13 +15,10 @@ warnings.filterwarnings("ignore", category=FutureWarning, module="transformers.m
 def load_data(file_path):
     predictions = []
     ground_truths = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                item = json.loads(line)
-                predictions.append(str(item.get('prediction', '')))
-                ground_truths.append(str(item.get('ground_truth', '')))
+    # One entry per example, even if the file still holds superseded retries
+    for item in read_results(file_path):
+        predictions.append(str(item.get('prediction', '')))
+        ground_truths.append(str(item.get('ground_truth', '')))
     return predictions, ground_truths
 
 def get_sacrebleu_scores(predictions, references):
@@ -45,10 +43,10 @@ def get_bert_scores(predictions, references):
     avg_f1 = sum(results["f1"]) / len(results["f1"])
     return avg_f1 * 100
 
-def get_tapas_scores(prediction_file, dataset_name, split_name):
+def get_tapas_scores(prediction_file, dataset_name, split_name, dataset_cache_dir=DEFAULT_CACHE_DIR):
     tapas = TapasTest("google/tapas-large-finetuned-tabfact")
-    data = MyData(prediction_file, dataset_name, split_name, tapas.tokenizer)
-    test_dataloader = DataLoader(data, batch_size=64, shuffle=False, num_workers=4)
+    data = MyData(prediction_file, dataset_name, split_name, tapas.tokenizer, dataset_cache_dir=dataset_cache_dir)
+    test_dataloader = make_dataloader(data, 64, DEFAULT_MAX_BATCH_TOKENS, num_workers=4)
     results = tapas.test(test_dataloader)
     return results["acc"] * 100
     
@@ -71,7 +69,7 @@ def get_prediction_lengths(predictions):
         total_length += len(word_tokenize(prediction))
     return total_length / len(predictions)
 
-def run_full_evaluation(predictions, references, prediction_file, dataset_name, split_name):
+def run_full_evaluation(predictions, references, prediction_file, dataset_name, split_name, dataset_cache_dir=DEFAULT_CACHE_DIR):
     all_scores = {}
     
     print("--- Start calculating metrics ---")
@@ -89,7 +87,7 @@ def run_full_evaluation(predictions, references, prediction_file, dataset_name,
     all_scores["BERTScore"] = get_bert_scores(predictions, references)
     
     print("Calculating TAPAS-Acc...")
-    all_scores["TAPAS-Acc"] = get_tapas_scores(prediction_file, dataset_name, split_name)
+    all_scores["TAPAS-Acc"] = get_tapas_scores(prediction_file, dataset_name, split_name, dataset_cache_dir)
     
     print("Calculating AutoACU...")
     all_scores["AutoACU"] = get_autoacu_scores(predictions, references)
@@ -101,6 +99,10 @@ def run_full_evaluation(predictions, references, prediction_file, dataset_name,
     return all_scores
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_cache_dir", type=str, default=DEFAULT_CACHE_DIR) # the --dataset_cache_dir of the run_llm.py runs
+    args = parser.parse_args()
+
     try:
         nltk.data.find('tokenizers/punkt')
     except LookupError:
@@ -140,7 +142,8 @@ if __name__ == "__main__":
             references=ground_truths,
             prediction_file=config['file_path'],
             dataset_name=config['dataset_name'],
-            split_name=config['split_name']
+            split_name=config['split_name'],
+            dataset_cache_dir=args.dataset_cache_dir
         )
         final_results[name] = scores
         
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class CacheMissError(KeyError):
+    '''
+    Raised in replay mode when a request has no cached response
+    '''
+
+
+def request_key(model, messages, tools=None, temperature=None):
+    '''
+    Content-addressed key of a chat completion request
+    '''
+    payload = {"model": model, "messages": messages, "tools": tools, "temperature": temperature}
+    serialized = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    '''
+    On-disk SQLite cache of LLM responses, keyed by request_key.
+
+    mode is "readwrite" (look up, store misses) or "replay" (look up only; a miss
+    raises CacheMissError so no request ever reaches the API). Entries older than
+    max_age_days are ignored and pruned, and the least recently used entries are
+    evicted once the cache holds more than max_entries.
+    '''
+    def __init__(self, path, mode="readwrite", max_entries=None, max_age_days=None):
+        if mode not in ("readwrite", "replay"):
+            raise ValueError(f"Unknown cache mode: {mode}")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        if mode == "readwrite":
+            self.evict()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_age and now - row[1] > self.max_age:
+                row = None
+            if row is None:
+                self.misses += 1
+                if self.mode == "replay":
+                    raise CacheMissError(key)
+                return None
+            self.hits += 1
+            if self.mode == "readwrite":
+                self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        if self.mode == "replay":
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            self.conn.commit()
+            self.stores += 1
+        if self.max_entries and self.stores % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            if self.max_age:
+                self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self.conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
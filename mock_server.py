@@ -0,0 +1,279 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llm_cache import CacheMissError, ResponseCache, request_key
+from table_compaction import count_tokens
+
+MODES = ["synthetic", "replay", "record"]
+LATENCY_DISTRIBUTIONS = ["uniform", "lognormal"]
+
+# Canned responses of the synthetic mode, chosen by a keyword of the stage's system prompt
+SYNTHETIC_PLAN = "1. Which rows of the table are relevant to the question?\n2. What values in those rows answer the question?"
+SYNTHETIC_FUNCTION = '''```python
+def lookup_rows(table, keyword):
+    rows = [row for row in table["rows"] if any(str(keyword).lower() in str(cell).lower() for cell in row)]
+    return str([dict(zip(table["header"], row)) for row in (rows or table["rows"])[:3]])
+```'''
+
+
+def synthetic_content(messages):
+    system = messages[0]["content"] if messages else ""
+    user = messages[-1]["content"] if messages else ""
+    if "plan generation" in system:
+        return SYNTHETIC_PLAN
+    if "plan checking" in system:
+        return "YES"
+    if "Python programmer" in system or "function extraction" in system or "debugging" in system:
+        return SYNTHETIC_FUNCTION
+    if "JSON array of strings" in user:
+        n_items = len(re.findall(r"^Item \d+:", user, flags=re.M)) - 2  # minus the two example items
+        return json.dumps([f"Synthetic sentence {i + 1}." for i in range(max(n_items, 0))])
+    if "sentences" in system:
+        return "Synthetic sentence."
+    if "answering questions directly" in system:
+        return "Synthetic answer."
+    return "Synthetic final answer."
+
+
+def synthetic_tool_call(messages, tools):
+    function = tools[0]["function"]
+    words = re.findall(r"\w+", messages[-1]["content"]) or ["value"]
+    arguments = {}
+    for name, spec in function.get("parameters", {}).get("properties", {}).items():
+        arguments[name] = 0 if spec.get("type") in ("integer", "number") else words[-1]
+    return {"id": f"call_{uuid.uuid4().hex[:12]}", "name": function["name"], "arguments": json.dumps(arguments)}
+
+
+class MockLLMServer:
+    '''
+    Local stand-in for the OpenAI chat.completions endpoint, for benchmarks and
+    regression tests that must not use the network or API quota.
+
+    mode is "synthetic" (canned answers per pipeline stage), "replay" (answers recorded
+    in a ResponseCache file; a miss is a 400 error) or "record" (forward requests that
+    are not recorded yet to the real API with the usual credentials, and store the
+    answers). Recordings use the keys of openai_utils' response cache, so a file written
+    by run_llm.py --cache_path can be replayed as well.
+    Each request sleeps latency_ms plus up to latency_jitter_ms ("uniform"), or a
+    lognormal latency with median latency_ms and shape latency_sigma ("lognormal"), and
+    fails with a 429 (with Retry-After) or a 500 at the given rates; the draws come
+    from a seeded RNG.
+    '''
+    def __init__(self, mode="synthetic", cache_path=None, latency_ms=0.0, latency_jitter_ms=0.0,
+                 rate_429=0.0, rate_500=0.0, retry_after=1.0, seed=0, host="127.0.0.1", port=0,
+                 latency_distribution="uniform", latency_sigma=0.5):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {latency_distribution}")
+        if mode != "synthetic" and not cache_path:
+            raise ValueError(f"{mode} mode needs a cache_path")
+        self.mode = mode
+        self.cache = ResponseCache(cache_path, mode="replay" if mode == "replay" else "readwrite") if cache_path else None
+        self.upstream = None
+        if mode == "record":
+            import openai_utils
+            self.upstream = openai_utils.create_client()
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.latency_distribution = latency_distribution
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "completions": 0, "tool_calls": 0, "errors_429": 0, "errors_500": 0, "replay_misses": 0}
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        '''
+        Serve on a background thread; returns the base URL for openai_utils.configure_client
+        '''
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-llm-server", daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.cache is not None:
+            self.cache.conn.close()
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def draw(self):
+        '''
+        Returns (injected status or None, latency in seconds) for one request
+        '''
+        with self.lock:
+            self.stats["requests"] += 1
+            error_draw = self.random.random()
+            if self.latency_distribution == "lognormal" and self.latency_ms > 0:
+                latency = self.random.lognormvariate(math.log(self.latency_ms), self.latency_sigma) / 1000
+            else:
+                latency = (self.latency_ms + self.random.random() * self.latency_jitter_ms) / 1000
+        if error_draw < self.rate_429:
+            self._count("errors_429")
+            return 429, latency
+        if error_draw < self.rate_429 + self.rate_500:
+            self._count("errors_500")
+            return 500, latency
+        return None, latency
+
+    def respond(self, body):
+        '''
+        Returns (status, response JSON) for a chat.completions request body
+        '''
+        messages = body.get("messages", [])
+        tools = body.get("tools")
+        key = request_key(body.get("model"), messages, tools=tools, temperature=body.get("temperature"))
+        try:
+            recorded = self.cache.get(key) if self.cache is not None else None
+        except CacheMissError:
+            self._count("replay_misses")
+            return 400, {"error": {"message": f"no recorded response for request {key}", "type": "invalid_request_error", "code": "replay_miss"}}
+        if recorded is None and self.mode == "record":
+            forwarded = {name: value for name, value in body.items() if name != "stream"}
+            recorded = self._record(self.upstream.chat.completions.create(**forwarded))
+            self.cache.put(key, recorded)
+        if recorded is None:
+            if tools:
+                recorded = {"tool_call": synthetic_tool_call(messages, tools)}
+            else:
+                recorded = {"content": synthetic_content(messages)}
+        self._count("tool_calls" if "tool_call" in recorded else "completions")
+        return 200, self._completion(body, recorded)
+
+    @staticmethod
+    def _record(response):
+        message = response.choices[0].message
+        usage = getattr(response, "usage", None)
+        recorded = {}
+        if getattr(message, "tool_calls", None):
+            tool_call = message.tool_calls[0]
+            recorded["tool_call"] = {"id": tool_call.id, "name": tool_call.function.name, "arguments": tool_call.function.arguments}
+        else:
+            recorded["content"] = message.content
+        if usage is not None:
+            recorded["usage"] = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+        return recorded
+
+    @staticmethod
+    def _completion(body, recorded):
+        if "tool_call" in recorded:
+            tool_call = recorded["tool_call"]
+            message = {"role": "assistant", "content": None, "tool_calls": [
+                {"id": tool_call["id"], "type": "function", "function": {"name": tool_call["name"], "arguments": tool_call["arguments"]}}
+            ]}
+            finish_reason = "tool_calls"
+            output_text = tool_call["arguments"]
+        else:
+            message = {"role": "assistant", "content": recorded["content"]}
+            finish_reason = "stop"
+            output_text = recorded["content"] or ""
+        usage = recorded.get("usage") or {
+            "prompt_tokens": sum(count_tokens(str(m.get("content") or "")) for m in body.get("messages", [])),
+            "completion_tokens": count_tokens(output_text),
+        }
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {**usage, "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"]},
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        mock = self.server.mock
+        if self.path.rstrip("/").endswith("/models"):
+            self._send(200, {"object": "list", "data": []})
+        elif self.path.rstrip("/").endswith("/stats"):
+            with mock.lock:
+                self._send(200, dict(mock.stats))
+        else:
+            self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        # Azure deployments post to /openai/deployments/<name>/chat/completions?api-version=...
+        if not self.path.split("?")[0].rstrip("/").endswith("/chat/completions"):
+            self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        error_status, latency = mock.draw()
+        time.sleep(latency)
+        if error_status == 429:
+            self._send(429, {"error": {"message": "Rate limit reached (injected)", "type": "rate_limit_error"}}, {"Retry-After": str(mock.retry_after)})
+            return
+        if error_status == 500:
+            self._send(500, {"error": {"message": "Internal server error (injected)", "type": "server_error"}})
+            return
+        try:
+            status, payload = mock.respond(body)
+        except Exception as e:
+            status, payload = 502, {"error": {"message": f"upstream request failed: {e}", "type": "server_error"}}
+        self._send(status, payload)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, default="synthetic", choices=MODES)
+    parser.add_argument("--cache_path", type=str, default=None) # recorded responses (replay/record), same format as run_llm --cache_path
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency_ms", type=float, default=0.0) # added to every request
+    parser.add_argument("--latency_jitter_ms", type=float, default=0.0) # uniform extra latency on top of --latency_ms
+    parser.add_argument("--latency_distribution", type=str, default="uniform", choices=LATENCY_DISTRIBUTIONS) # lognormal: median --latency_ms
+    parser.add_argument("--latency_sigma", type=float, default=0.5) # shape of the lognormal distribution
+    parser.add_argument("--rate_429", type=float, default=0.0) # fraction of requests answered with 429 + Retry-After
+    parser.add_argument("--rate_500", type=float, default=0.0) # fraction of requests answered with 500
+    parser.add_argument("--retry_after", type=float, default=1.0) # Retry-After seconds sent with injected 429s
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.mode, args.cache_path, args.latency_ms, args.latency_jitter_ms,
+                           args.rate_429, args.rate_500, args.retry_after, args.seed, args.host, args.port,
+                           args.latency_distribution, args.latency_sigma)
+    print(f"Serving {args.mode} responses at {server.base_url} (run_llm.py --api_base_url {server.base_url})")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(f"Server stats: {server.stats}")
@@ -1,44 +1,435 @@
+import openai
 from openai import OpenAI, AzureOpenAI
+from types import SimpleNamespace
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from llm_cache import ResponseCache, request_key
+import budget
+import tracing
+import contextvars
 import os
+import random
+import threading
+import time
 
-# Initialize client based on available environment variables
-if os.getenv("AZURE_OPENAI_ENDPOINT") and os.getenv("AZURE_OPENAI_API_KEY"):
-    # Use Azure OpenAI
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY")
-    )
-    print("Using Azure OpenAI")
-elif os.getenv("OPENAI_API_KEY"):
-    # Use regular OpenAI
-    client = OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY")
-    )
-    print("Using OpenAI")
-else:
+def create_client(base_url=None, api_key=None):
+    '''
+    Build a client from the environment variables, or for the OpenAI-compatible
+    server at base_url (e.g. mock_server.py) when it is given
+    '''
+    if base_url:
+        print(f"Using OpenAI-compatible server at {base_url}")
+        return OpenAI(
+            base_url=base_url,
+            api_key=api_key or os.getenv("OPENAI_API_KEY") or "unused",
+            max_retries=0  # retries are handled by the RequestScheduler below
+        )
+    if os.getenv("AZURE_OPENAI_ENDPOINT") and os.getenv("AZURE_OPENAI_API_KEY"):
+        # Use Azure OpenAI
+        print("Using Azure OpenAI")
+        return AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            max_retries=0  # retries are handled by the RequestScheduler below
+        )
+    if os.getenv("OPENAI_API_KEY"):
+        # Use regular OpenAI
+        print("Using OpenAI")
+        return OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            max_retries=0  # retries are handled by the RequestScheduler below
+        )
     raise ValueError("Please set either Azure OpenAI credentials (AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY) or OpenAI credentials (OPENAI_API_KEY)")
 
-def get_completion(messages, model="gpt-35-turbo"):
+# Created on first request, so importing this module (e.g. for a replay-only run) needs no credentials
+client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                client = create_client()
+    return client
+
+def configure_client(base_url=None, api_key=None):
+    global client
+    client = create_client(base_url, api_key)
+    return client
+
+class ClientPool:
+    '''
+    Spreads requests over several OpenAI-compatible endpoints (e.g. a few vLLM servers).
+
+    Each request goes to the healthy endpoint with the fewest requests in flight. An
+    endpoint is marked unhealthy after max_failures consecutive connection or server
+    errors, and a background thread probes every endpoint's /models route each
+    health_interval seconds to take it out of or back into rotation. When no endpoint
+    is healthy, requests still go to the least loaded one rather than failing outright.
+    '''
+    def __init__(self, base_urls, api_key=None, health_interval=30.0, max_failures=3):
+        self.endpoints = [{
+            "base_url": base_url,
+            "client": create_client(base_url, api_key),
+            "outstanding": 0,
+            "failures": 0,
+            "healthy": True,
+            "requests": 0,
+            "errors": 0,
+        } for base_url in base_urls]
+        self.max_failures = max_failures
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.stopped = threading.Event()
+        if health_interval:
+            threading.Thread(target=self._health_loop, name="client-pool-health", daemon=True).start()
+
+    def _acquire(self):
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint["healthy"]] or self.endpoints
+            # Least outstanding requests; ties rotate so idle endpoints share the load
+            self.next_index += 1
+            endpoint = min(candidates, key=lambda e: (e["outstanding"], (self.endpoints.index(e) - self.next_index) % len(self.endpoints)))
+            endpoint["outstanding"] += 1
+            endpoint["requests"] += 1
+            return endpoint
+
+    def _release(self, endpoint, error=None):
+        with self.lock:
+            endpoint["outstanding"] -= 1
+            # Throttling and bad requests say nothing about the endpoint's health
+            if error is not None and is_retryable(error) and getattr(error, "status_code", None) != 429:
+                endpoint["errors"] += 1
+                endpoint["failures"] += 1
+                if endpoint["failures"] >= self.max_failures:
+                    endpoint["healthy"] = False
+            elif error is None:
+                endpoint["failures"] = 0
+                endpoint["healthy"] = True
+
+    def create(self, **kwargs):
+        endpoint = self._acquire()
+        try:
+            response = endpoint["client"].chat.completions.create(**kwargs)
+        except Exception as e:
+            self._release(endpoint, e)
+            raise
+        self._release(endpoint)
+        return response
+
+    def _health_loop(self):
+        while not self.stopped.wait(self.health_interval):
+            for endpoint in self.endpoints:
+                try:
+                    endpoint["client"].models.list()
+                    healthy = True
+                except Exception:
+                    healthy = False
+                with self.lock:
+                    endpoint["healthy"] = healthy
+                    if healthy:
+                        endpoint["failures"] = 0
+
+    def close(self):
+        self.stopped.set()
+
+    def stats(self):
+        with self.lock:
+            return {endpoint["base_url"]: {key: endpoint[key] for key in ("requests", "errors", "outstanding", "healthy")} for endpoint in self.endpoints}
+
+# Optional endpoint pools, per model (None: every model without a pool of its own),
+# enabled with configure_endpoints; models without a pool use the default client
+pools = {}
+
+def configure_endpoints(endpoints, api_key=None, health_interval=30.0, max_failures=3):
+    '''
+    endpoints: list of (model or None, base_url)
+    '''
+    for pool in pools.values():
+        pool.close()
+    pools.clear()
+    grouped = {}
+    for model, base_url in endpoints:
+        grouped.setdefault(model, []).append(base_url)
+    for model, base_urls in grouped.items():
+        pools[model] = ClientPool(base_urls, api_key, health_interval, max_failures)
+    return pools
+
+def create_completion(**kwargs):
+    pool = pools.get(kwargs.get("model"), pools.get(None))
+    if pool is None:
+        return get_client().chat.completions.create(**kwargs)
+    return pool.create(**kwargs)
+
+# Stages that can be routed to their own model with configure_stage_models
+STAGES = (
+    "plan_generation", "check_plan", "function_generator", "function_extraction", "argument_binding",
+    "self_debugging", "ask_directly", "sentence_generator", "final_answer",
+)
+
+# stage -> model overriding the model passed by the caller
+stage_models = {}
+
+def configure_stage_models(mapping):
+    unknown = set(mapping) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))} (expected some of {', '.join(STAGES)})")
+    stage_models.clear()
+    stage_models.update(mapping)
+    return stage_models
+
+def route_model(stage, model):
+    return stage_models.get(stage, model)
+
+class TokenBucket:
+    '''
+    Token bucket refilled continuously at `per_minute` units per minute
+    '''
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        # Requests larger than the whole bucket wait for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_time = (amount - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def adjust(self, amount):
+        # Correct an earlier estimate once the real usage is known; may go negative
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+def estimate_tokens(messages):
+    # Rough prompt size used for the tokens-per-minute budget (~4 characters per token)
+    return sum(len(str(message.get("content") or "")) for message in messages) // 4 + 4 * len(messages)
+
+def is_retryable(error):
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+    return None
+
+class RequestScheduler:
+    '''
+    Central gate for every chat completion request.
+
+    Enforces optional requests-per-minute and tokens-per-minute budgets with token
+    buckets, and retries 429/5xx/connection errors with jittered exponential backoff,
+    honoring Retry-After. A throttled response pauses all callers until the server's
+    retry time, so concurrent workers do not keep hammering the endpoint.
+    '''
+    def __init__(self, rpm=None, tpm=None, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _wait_for_pause(self):
+        while True:
+            with self.lock:
+                delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def call(self, create, messages, **kwargs):
+        '''
+        Returns the response and the number of retries it took
+        '''
+        estimated_tokens = estimate_tokens(messages)
+        attempt = 0
+        while True:
+            self._wait_for_pause()
+            if self.request_bucket:
+                self.request_bucket.acquire(1)
+            if self.token_bucket:
+                self.token_bucket.acquire(estimated_tokens)
+            try:
+                response = create(messages=messages, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    e.retries = attempt  # for the call record of the failed request
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if isinstance(e, openai.RateLimitError) or getattr(e, "status_code", None) == 429:
+                    with self.lock:
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                attempt += 1
+                print(f"Retrying request ({attempt}/{self.max_retries}) in {delay:.1f}s after error: {e}")
+                time.sleep(delay)
+                continue
+            if self.token_bucket and getattr(response, "usage", None) is not None:
+                self.token_bucket.adjust(response.usage.total_tokens - estimated_tokens)
+            return response, attempt
+
+scheduler = RequestScheduler()
+
+def configure_scheduler(rpm=None, tpm=None, max_retries=6, base_delay=1.0, max_delay=60.0):
+    global scheduler
+    scheduler = RequestScheduler(rpm=rpm, tpm=tpm, max_retries=max_retries, base_delay=base_delay, max_delay=max_delay)
+    return scheduler
+
+# Per-call accounting: every request is recorded into the list bound by record_calls
+_call_log = contextvars.ContextVar("call_log", default=None)
+
+@contextmanager
+def record_calls():
+    '''
+    Collect one entry per LLM call made in this context
+    (stage, model, prompt/completion tokens, latency, retries, cached, error)
+    '''
+    calls = []
+    token = _call_log.set(calls)
     try:
-        response = client.chat.completions.create(
+        yield calls
+    finally:
+        _call_log.reset(token)
+
+def in_current_context(fn):
+    '''
+    Wrap fn so that calls made from thread pool workers are recorded in the caller's context
+    '''
+    context = contextvars.copy_context()
+    submitted = tracing.submit_time()
+    def call(*args, **kwargs):
+        tracing.queued_since(submitted)
+        return fn(*args, **kwargs)
+    def run(*args, **kwargs):
+        return context.copy().run(call, *args, **kwargs)
+    return run
+
+def record_call(stage, model, start, response=None, retries=0, cached=False, error=False):
+    # A failed request is recorded too: it used quota and counts against the call budgets
+    usage = getattr(response, "usage", None)
+    if not cached:
+        budget.charge((getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0))
+    calls = _call_log.get()
+    if calls is None:
+        return
+    calls.append({
+        "stage": stage,
+        "model": model,
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "latency": round(time.monotonic() - start, 4),
+        "retries": retries,
+        "cached": cached,
+        "error": error,
+    })
+
+# Optional on-disk response cache, enabled with configure_cache
+cache = None
+
+def configure_cache(path, mode="readwrite", max_entries=None, max_age_days=None):
+    global cache
+    cache = ResponseCache(path, mode=mode, max_entries=max_entries, max_age_days=max_age_days)
+    return cache
+
+def get_completion(messages, model="gpt-35-turbo", stage=None):
+    start = time.monotonic()
+    model = route_model(stage, model)
+    temperature = 0.7
+    key = None
+    if cache is not None:
+        key = request_key(model, messages, temperature=temperature)
+        cached = cache.get(key)
+        if cached is not None:
+            record_call(stage, model, start, cached=True)
+            return cached["content"]
+    response, retries = None, 0
+    try:
+        response, retries = scheduler.call(
+            create_completion,
+            messages,
             model=model,
-            messages=messages,
-            temperature=0.7
+            temperature=temperature
         )
-        return response.choices[0].message.content
     except Exception as e:
-        print("get_completion error:", e)
-        return None
+        retries = getattr(e, "retries", 0)
+        raise
+    finally:
+        record_call(stage, model, start, response, retries, error=response is None)
+    content = response.choices[0].message.content
+    if cache is not None and content is not None:
+        cache.put(key, {"content": content})
+    return content
+
+def tool_call_from_dict(data):
+    return SimpleNamespace(id=data["id"], type="function", function=SimpleNamespace(name=data["name"], arguments=data["arguments"]))
 
-def get_function_completion(messages, functions=None, function_call=None, model="gpt-35-turbo"):
+def get_function_completion(messages, functions=None, function_call=None, model="gpt-35-turbo", stage="argument_binding"):
+    start = time.monotonic()
+    model = route_model(stage, model)
+    key = None
+    if cache is not None:
+        key = request_key(model, messages, tools=functions)
+        cached = cache.get(key)
+        if cached is not None:
+            record_call(stage, model, start, cached=True)
+            return tool_call_from_dict(cached["tool_call"])
+    response, retries = None, 0
     try:
-        response = client.chat.completions.create(
+        response, retries = scheduler.call(
+            create_completion,
+            messages,
             model=model,
-            messages=messages,
             tools=functions,
             tool_choice="auto",
         )
-        return response.choices[0].message.tool_calls[0]
     except Exception as e:
-        print("get_function_completion error:", e)
+        retries = getattr(e, "retries", 0)
+        raise
+    finally:
+        record_call(stage, model, start, response, retries, error=response is None)
+    tool_calls = response.choices[0].message.tool_calls
+    if not tool_calls:
+        # The model answered in text instead of calling the function
         return None
+    tool_call = tool_calls[0]
+    if cache is not None:
+        cache.put(key, {"tool_call": {"id": tool_call.id, "name": tool_call.function.name, "arguments": tool_call.function.arguments}})
+    return tool_call
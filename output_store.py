@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import threading
+
+# Sidecar index of an output JSONL file: one JSON line [example_id, status, byte offset, byte length]
+# per result, in the order the results were appended
+INDEX_SUFFIX = ".index"
+
+
+def get_index_path(output_path):
+    return output_path + INDEX_SUFFIX
+
+
+def result_status(item):
+    return "error" if item.get("prediction") == "error" else "ok"
+
+
+def _scan(f, start):
+    '''
+    Index entries of the complete lines of f from byte offset start, and the offset after the last one
+    '''
+    entries = []
+    offset = start
+    f.seek(start)
+    for line in f:
+        if not line.endswith(b"\n"):
+            break  # torn write of a crashed run
+        try:
+            item = json.loads(line) if line.strip() else None
+        except ValueError:
+            item = None
+        if item is not None:
+            entries.append([str(item["example_id"]), result_status(item), offset, len(line)])
+        offset += len(line)
+    return entries, offset
+
+
+def _read_index(index_path):
+    entries = []
+    with open(index_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            entries.append(json.loads(line))
+    return entries
+
+
+def _index_matches(f, entry):
+    # The last indexed line must still be where the index says, e.g. not after an external rewrite
+    example_id, _, offset, length = entry
+    f.seek(offset)
+    line = f.read(length)
+    try:
+        return line.endswith(b"\n") and str(json.loads(line)["example_id"]) == example_id
+    except (ValueError, KeyError):
+        return False
+
+
+def load_index(output_path, write=False):
+    '''
+    Index entries of output_path, and the byte offset where its complete lines end.
+
+    The sidecar index is trusted up to its last entry and extended by scanning only the
+    lines appended after it; a missing or stale index is rebuilt with one streaming scan.
+    Only with write is the rebuilt index saved, so readers work on read-only outputs.
+    '''
+    if not os.path.exists(output_path):
+        return [], 0
+    index_path = get_index_path(output_path)
+    entries = _read_index(index_path) if os.path.exists(index_path) else []
+    with open(output_path, "rb") as f:
+        if entries and (entries[-1][2] + entries[-1][3] > os.path.getsize(output_path) or not _index_matches(f, entries[-1])):
+            entries = []
+        start = entries[-1][2] + entries[-1][3] if entries else 0
+        tail, end = _scan(f, start)
+    if not entries or tail:
+        entries += tail
+        if write:
+            _write_index(index_path, entries)
+    return entries, end
+
+
+def _write_index(index_path, entries):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, index_path)
+
+
+def latest_entries(entries):
+    '''
+    example_id -> the entry that represents it: its latest success, or its latest error if it never succeeded
+    '''
+    latest = {}
+    for entry in entries:
+        if entry[1] == "ok" or latest.get(entry[0], [None, "error"])[1] == "error":
+            latest[entry[0]] = entry
+    return latest
+
+
+def scan_output(output_path):
+    '''
+    Resume state of an output file from its index alone: (ids of finished examples, success count, error count)
+    '''
+    if not os.path.exists(output_path):
+        return set(), 0, 0
+    latest = latest_entries(load_index(output_path, write=True)[0])
+    done = {example_id for example_id, entry in latest.items() if entry[1] == "ok"}
+    error_count = len(latest) - len(done)
+    print(f"✓ Resuming {output_path}: {len(done)} successful items, {error_count} failed items to retry")
+    return done, len(done), error_count
+
+
+def read_results(output_path):
+    '''
+    Yield one result per example (see latest_entries) in order of first appearance, seeking
+    past superseded entries instead of parsing them
+    '''
+    entries, _ = load_index(output_path)
+    latest = latest_entries(entries)
+    with open(output_path, "rb") as f:
+        for example_id, entry in latest.items():
+            f.seek(entry[2])
+            yield json.loads(f.read(entry[3]))
+
+
+class OutputStore:
+    '''
+    Append-only writer of an output JSONL file and its sidecar index.
+
+    Results are never rewritten in place: a retried example is appended again and its
+    new entry supersedes the old one for readers (read_results) and for resuming
+    (scan_output). compact() drops superseded entries as a separate, atomic step.
+    '''
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.index_path = get_index_path(output_path)
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        _, end = load_index(output_path, write=True)
+        if os.path.exists(output_path) and os.path.getsize(output_path) > end:
+            # Drop the torn last line of a crashed run so the next result starts on a line of its own
+            with open(output_path, "r+b") as f:
+                f.truncate(end)
+        self.lock = threading.Lock()
+        self.f = open(output_path, "ab")
+        self.index_f = open(self.index_path, "a", encoding="utf-8")
+
+    def append(self, result_item):
+        data = (json.dumps(result_item, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            offset = self.f.tell()
+            self.f.write(data)
+            self.f.flush()  # the result is on disk before the index points at it
+            self.index_f.write(json.dumps([str(result_item["example_id"]), result_status(result_item), offset, len(data)], ensure_ascii=False) + "\n")
+            self.index_f.flush()
+
+    def close(self):
+        self.f.close()
+        self.index_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compact(output_path, drop_errors=False):
+    '''
+    Rewrite output_path with one entry per example into a temporary file, then swap it in.
+    Returns (entries before, entries after)
+    '''
+    entries, _ = load_index(output_path)
+    tmp_path = output_path + ".compact"
+    for path in (tmp_path, get_index_path(tmp_path)):
+        if os.path.exists(path):
+            os.remove(path)  # left over from an interrupted compaction
+    kept = 0
+    with OutputStore(tmp_path) as store:
+        for item in read_results(output_path):
+            if drop_errors and result_status(item) == "error":
+                continue
+            store.append(item)
+            kept += 1
+    # The index is rebuilt from the new file if a crash lands between the two renames
+    os.replace(tmp_path, output_path)
+    os.replace(get_index_path(tmp_path), get_index_path(output_path))
+    return len(entries), kept
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_file", type=str) # JSONL written by run_llm.py
+    parser.add_argument("--drop_errors", action="store_true") # also drop examples that never succeeded
+    args = parser.parse_args()
+    before, after = compact(args.output_file, args.drop_errors)
+    print(f"✓ Compacted {args.output_file}: {before} entries -> {after}")
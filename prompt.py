@@ -1,7 +1,12 @@
 import re
+import ast
+import json
+import threading
 from openai_utils import get_completion
+from table_compaction import render_table, render_rows, render_table_columns
+from tracing import traced
 
-def plan_generation(query, old_plan, model):
+def plan_generation_messages(query, old_plan):
     prompt_system = "You are an expert plan generation assistant."
     prompt_user = f"""You are given a question over a table. Your task is to generate a plan by decomposing the question into a series of clear, non-overlapping sub-questions, so that answering each sub-question in order will allow you to answer the original question comprehensively. If no decomposition is needed, just return the original question.
 
@@ -44,11 +49,12 @@ Now, please generate a plan for the following question. If an old plan is presen
 Question: '''{query}'''
 Old Plan: '''{old_plan}'''
 """
-    messages = [
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    question_list = get_completion(messages, model)
+
+def parse_plan(question_list):
     question_list = question_list.replace("Improved Plan:\n", "")
     if '\n' in question_list:
         lines = question_list.split('\n')
@@ -57,8 +63,14 @@ Old Plan: '''{old_plan}'''
     question_list = [line.strip() for line in lines if line.strip()]
     return question_list
 
+@traced(cat="llm")
+def plan_generation(query, old_plan, model):
+    messages = plan_generation_messages(query, old_plan)
+    question_list = get_completion(messages, model, stage="plan_generation")
+    return parse_plan(question_list)
 
-def check_plan(query, sub_questions, model):
+
+def check_plan_messages(query, sub_questions):
     prompt_system = "You are an expert in iterative plan checking."
     prompt_user = f"""Given a complex question over a table and a set of decomposed sub-questions, your task is to check whether the sub-questions are informative enough to answer the complex question.
 
@@ -90,14 +102,25 @@ Sub-questions: '''{sub_questions}'''
 
 Your response (just YES or NO):"""
 
-    messages = [
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    check = get_completion(messages, model)
+
+@traced(cat="llm")
+def check_plan(query, sub_questions, model):
+    messages = check_plan_messages(query, sub_questions)
+    check = get_completion(messages, model, stage="check_plan")
+    return parse_check(check)
+
+def parse_check(check):
     return "YES" in check.upper()
 
-def function_generator(sub_question, table_data, model):
+def function_generator_messages(sub_question, table_data):
+    rows_text, n_rows_shown = render_rows("function_generator", table_data, sub_question)
+    rows_note = ""
+    if n_rows_shown < len(table_data["rows"]):
+        rows_note = f"**Note:** only {n_rows_shown} of the {len(table_data['rows'])} table rows are shown; the function will be run on the full table.\n"
     prompt_system = "You are an expert Python programmer who writes functions to extract structured data from tables."
     prompt_user = f"""Your task is to write a Python function that answers a question by extracting ALL relevant information from the provided table.
 
@@ -156,17 +179,62 @@ Now, write a Python function that follows these instructions precisely.
 **Question:** '''{sub_question}'''
 **Table Title:** '''{table_data["title"]}'''
 **Table Header:** '''{table_data["header"]}'''
-**Table Rows:** '''{table_data["rows"]}'''
-"""
-    messages = [
+**Table Rows:** '''{rows_text}'''
+{rows_note}"""
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    function_response = get_completion(messages, model)
+
+@traced(cat="llm")
+def function_generator(sub_question, table_data, model):
+    messages = function_generator_messages(sub_question, table_data)
+    function_response = get_completion(messages, model, stage="function_generator")
     return function_response
 
 
-def function_extraction(function_response, model):
+# How often function_extraction was answered locally vs. by the LLM fallback
+extraction_stats = {"local": 0, "fallback": 0}
+_extraction_lock = threading.Lock()
+
+def _first_function(source):
+    try:
+        module = ast.parse(source)
+    except SyntaxError:
+        # Prose around the code: try each top-level `def` block on its own
+        lines = source.split("\n")
+        for i, line in enumerate(lines):
+            if not line.startswith("def "):
+                continue
+            block = [line]
+            for next_line in lines[i + 1:]:
+                if next_line.strip() and not next_line[0].isspace():
+                    break
+                block.append(next_line)
+            function_source = _first_function("\n".join(block).rstrip())
+            if function_source:
+                return function_source
+        return None
+    for node in module.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            return ast.get_source_segment(source, node)
+    return None
+
+def extract_function_locally(function_response):
+    """
+    Find the first valid top-level function in fenced code blocks, then in the raw text.
+    Returns None when nothing parses
+    """
+    if not function_response:
+        return None
+    blocks = re.findall(r"```(?:python|py)?[ \t]*\n(.*?)```", function_response, re.DOTALL)
+    for candidate in blocks + [function_response]:
+        function_source = _first_function(candidate)
+        if function_source:
+            return function_source
+    return None
+
+def function_extraction_messages(function_response):
     prompt_system = "You are a python function extraction assistant. The user will give you a python script."
     prompt_user = f"""Give you a paragraph about the python function, including the function body, function description, function example usage, etc. You need to extract the function body from it. Your answer only needs to contain the extracted function(start with def), no other explanation is required, no function example usage is requried.
 
@@ -225,11 +293,24 @@ The following is the function response:
 '''
 {function_response}
 '''"""
-    messages = [
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    function_extract_response = get_completion(messages, model)
+
+@traced(cat="llm")
+def function_extraction(function_response, model):
+    function_extract_response = extract_function_locally(function_response)
+    with _extraction_lock:
+        extraction_stats["local" if function_extract_response else "fallback"] += 1
+    if function_extract_response:
+        return function_extract_response
+
+    messages = function_extraction_messages(function_response)
+    function_extract_response = get_completion(messages, model, stage="function_extraction")
+    return parse_extracted_function(function_extract_response)
+
+def parse_extracted_function(function_extract_response):
     # use regex to extract the function
     if '```python' in function_extract_response:
         function_extract_response = re.search(r'```python\n(.*?)\n```', function_extract_response, re.DOTALL).group(1)
@@ -241,7 +322,11 @@ The following is the function response:
     
     return function_extract_response
 
-def self_debugging(sub_question, table_data, function_extract_response, feedback, model):
+def self_debugging_messages(sub_question, table_data, function_extract_response, feedback):
+    table_text, n_rows_shown = render_table_columns("self_debugging", table_data, sub_question)
+    rows_note = ""
+    if n_rows_shown < len(table_data["rows"]):
+        rows_note = f"Note: only {n_rows_shown} of the {len(table_data['rows'])} table rows are shown; the function will be run on the full table.\n"
     prompt_system = "You are an expert in python script debugging."
     prompt_user = f"""There are some questions about the python script. You should fix the python script by given Feedback for wrong reasons. After your fixing, the python script given by you should run without error with the given table. Your answer only needs to contain the function(start with def).
 
@@ -253,19 +338,23 @@ The following is the function:
 '''
 The following is the table:
 '''
-{table_data}
+{table_text}
 '''
-The following is the Feedback:'''{feedback}'''"""
-    messages = [
+{rows_note}The following is the Feedback:'''{feedback}'''"""
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    self_debugging_response = get_completion(messages, model)
+
+@traced(cat="llm")
+def self_debugging(sub_question, table_data, function_extract_response, feedback, model):
+    messages = self_debugging_messages(sub_question, table_data, function_extract_response, feedback)
+    self_debugging_response = get_completion(messages, model, stage="self_debugging")
     corrected_function = function_extraction(self_debugging_response, model)
     return corrected_function
 
 
-def ask_directly(question, table_data, model):
+def ask_directly_messages(question, table_data):
     prompt_system = "You are an expert in answering questions directly according to the given table."
     prompt_user = f"""Answer the question according to the given table. Give your short-form answer directly, no other words.
 
@@ -280,15 +369,19 @@ Response:
 
 Now please give your short-form answer to the given question. Let's follow templates of examples.
 The following is the question:'''{question}'''
-The following is the table:'''{table_data}'''"""
-    messages = [
+The following is the table:'''{render_table("ask_directly", table_data, question)}'''"""
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    response = get_completion(messages, model)
+
+@traced(cat="llm")
+def ask_directly(question, table_data, model):
+    messages = ask_directly_messages(question, table_data)
+    response = get_completion(messages, model, stage="ask_directly")
     return response
 
-def sentence_generator(short_answer, sub_question, model):
+def sentence_generator_messages(short_answer, sub_question):
     prompt_system = "You are an expert in generating natural language sentences from structured data, adapting your style to the context."
     prompt_user = f"""Your task is to convert the structured 'Data' into a single, high-quality, factual sentence that answers the 'Question'.
 The style of the sentence should mimic the provided examples.
@@ -321,14 +414,76 @@ Now, generate the sentence based on the following inputs.
 **Question:** '''{sub_question}'''
 **Data:** '''{short_answer}'''
 """
-    messages = [
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    long_answer = get_completion(messages, model)
+
+@traced(cat="llm")
+def sentence_generator(short_answer, sub_question, model):
+    messages = sentence_generator_messages(short_answer, sub_question)
+    long_answer = get_completion(messages, model, stage="sentence_generator")
     return long_answer
 
-def generate_final_answer_fetaqa(query, answer_list, model):
+def sentence_generator_batch_messages(items):
+    prompt_system = "You are an expert in generating natural language sentences from structured data, adapting your style to the context."
+    numbered_items = "\n\n".join(
+        f"Item {i + 1}:\n**Question:** '''{sub_question}'''\n**Data:** '''{short_answer}'''"
+        for i, (sub_question, short_answer) in enumerate(items)
+    )
+    prompt_user = f"""Your task is to convert the structured 'Data' of each item into a single, high-quality, factual sentence that answers the item's 'Question'.
+The style of the sentences should mimic the provided examples.
+
+**INSTRUCTIONS:**
+1.  Carefully analyze the 'Data' of each item (which is a dictionary or a list of dictionaries).
+2.  Synthesize all information from the 'Data' into a flowing, natural sentence.
+3.  Ensure each sentence directly and completely answers its own 'Question'.
+4.  Do not add information not present in the 'Data', and do not mix information between items.
+5.  **Output only a JSON array of strings, one sentence per item, in the same order as the items.**
+
+---
+**Example:**
+Item 1:
+**Question:** '''What TV shows was Shagun Sharma seen in 2019?'''
+**Data:** '''[{{'Title': 'Laal Ishq', 'Role': 'Pernia'}}, {{'Title': 'Vikram Betaal Ki Rahasya Gatha', 'Role': 'Rukmani'}}, {{'Title': 'Shaadi Ke Siyape', 'Role': 'Dua'}}]'''
+
+Item 2:
+**Question:** '''Who was the driver of the car number 23 in the 2008 Nascar Craftsman Truck Series?'''
+**Data:** '''{{'Driver': 'Johnny Benson', 'Team': 'Bill Davis Racing'}}'''
+
+**Generated Sentences:**
+["In 2019, Shagun Sharma appeared in Laal Ishq as Pernia, Vikram Betaal Ki Rahasya Gatha as Rukmani, and Shaadi Ke Siyape as Dua.", "The driver of car number 23 in the 2008 Nascar Craftsman Truck Series was Johnny Benson, who drove for Bill Davis Racing."]
+
+---
+Now, generate the sentences for the following {len(items)} items.
+
+{numbered_items}
+"""
+    return [
+        {"role": "system", "content": prompt_system},
+        {"role": "user", "content": prompt_user}
+    ]
+
+@traced(cat="llm")
+def sentence_generator_batch(items, model):
+    """
+    sentence_generator for all (sub_question, short_answer) pairs of a plan in one request.
+    Returns the list of sentences, or None when the response does not parse
+    """
+    messages = sentence_generator_batch_messages(items)
+    response = get_completion(messages, model, stage="sentence_generator")
+    return parse_sentences(response, len(items))
+
+def parse_sentences(response, n_items):
+    try:
+        sentences = json.loads(response[response.index("["):response.rindex("]") + 1])
+    except (AttributeError, ValueError):
+        return None
+    if not isinstance(sentences, list) or len(sentences) != n_items or not all(isinstance(sentence, str) for sentence in sentences):
+        return None
+    return sentences
+
+def generate_final_answer_fetaqa_messages(query, answer_list):
     prompt_system = "You are an expert answer generator that produces concise, direct answers."
     prompt_user = f"""You will be given a main 'Question' and a 'Fact List'. Your task is to synthesize these facts into a final, concise answer.
 
@@ -356,14 +511,18 @@ Answer: In 2016 and 2017, Platt played in Dear Evan Hansen on Broadway at the Mu
 **Question:** '''{query}'''
 **Fact List:** '''{answer_list}'''
 """
-    messages = [
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    final_answer = get_completion(messages, model)
+
+@traced(cat="llm")
+def generate_final_answer_fetaqa(query, answer_list, model):
+    messages = generate_final_answer_fetaqa_messages(query, answer_list)
+    final_answer = get_completion(messages, model, stage="final_answer")
     return final_answer
 
-def generate_final_answer_qtsumm(query, answer_list, model):
+def generate_final_answer_qtsumm_messages(query, answer_list):
     prompt_system = "You are an expert summary generator that produces comprehensive, flowing summaries."
     prompt_user = f"""You will be given a main 'Query' and a 'Fact List'. Your task is to synthesize these facts into a final, comprehensive summary.
 
@@ -385,9 +544,13 @@ Summary: Yes, an athlete from the United States participated in the Women's 50 m
 **Query:** '''{query}'''
 **Fact List:** '''{answer_list}'''
 """
-    messages = [
+    return [
         {"role": "system", "content": prompt_system},
         {"role": "user", "content": prompt_user}
     ]
-    final_answer = get_completion(messages, model)
+
+@traced(cat="llm")
+def generate_final_answer_qtsumm(query, answer_list, model):
+    messages = generate_final_answer_qtsumm_messages(query, answer_list)
+    final_answer = get_completion(messages, model, stage="final_answer")
     return final_answer
@@ -2,11 +2,25 @@
 import argparse
 import os
 import json
-from datasets import load_dataset
+from dataset_cache import DEFAULT_CACHE_DIR, load_unified
+from sharding import get_shard_path, select_shard
+from output_store import OutputStore, scan_output
+from trace_store import TraceStore, get_trace_store_path
 import ast
+import re
 from prompt import *
-from openai_utils import get_function_completion
+import openai_utils
+import table_compaction
+import sandbox
+import budget
+import tracing
+from tracing import traced
+from openai_utils import get_function_completion, record_calls, in_current_context
 import time
+import itertools
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 def json_serialize_safe(obj):
     """Convert objects to JSON-serializable format"""
@@ -61,7 +75,124 @@ def create_function_from_string(function_name, function_string):
     exec(function_string)
     return locals()[function_name]
 
-def execute_function_call(sub_question, table_data, function_extract_response, model):
+class ExampleState:
+    """
+    Mutable state shared by all stages and plan iterations of one example.
+    With a checkpoint_path, completed stage results are also persisted there so that
+    a failed example resumes from its last completed stage on the next run
+    """
+    def __init__(self, checkpoint_path=None):
+        self.lock = threading.Lock()
+        # (sub_question, function_args) -> bound arguments
+        self.argument_cache = {}
+        # normalized sub-question -> (long_answer, log_data, iter_num) from earlier plan iterations
+        self.sub_question_results = {}
+        # stage key -> result of that stage, e.g. "iter1/plan" or "sq/<question>/function"
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = {}
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                self.checkpoint = json.load(f)
+
+    def has_checkpoint(self, key):
+        with self.lock:
+            return key in self.checkpoint
+
+    def get_checkpoint(self, key, default=None):
+        with self.lock:
+            return self.checkpoint.get(key, default)
+
+    def checkpointed(self, key, fn):
+        """
+        Return the stored result of stage `key`, or run fn and store its result
+        """
+        with self.lock:
+            if key in self.checkpoint:
+                return self.checkpoint[key]
+        value = fn()
+        with self.lock:
+            self.checkpoint[key] = value
+            if self.checkpoint_path:
+                tmp_path = self.checkpoint_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.checkpoint, f, ensure_ascii=False, default=str)
+                os.replace(tmp_path, self.checkpoint_path)
+        return value
+
+    def lookup_sub_question(self, sub_question):
+        with self.lock:
+            return self.sub_question_results.get(normalize_question(sub_question))
+
+    def store_sub_question(self, sub_question, long_answer, log_data, iter_num):
+        with self.lock:
+            self.sub_question_results.setdefault(normalize_question(sub_question), (long_answer, log_data, iter_num))
+
+def get_checkpoint_path(checkpoint_dir, example_id):
+    return os.path.join(checkpoint_dir, re.sub(r"[^\w.-]", "_", str(example_id)) + ".json")
+
+def normalize_question(question):
+    # Ignore plan numbering, case, punctuation and spacing when matching sub-questions
+    question = re.sub(r"^\s*(\d+[.)]|[-*])\s*", "", question)
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+# How function arguments were bound: reused, matched locally, or asked from the LLM
+argument_stats = {"cached": 0, "local": 0, "llm": 0}
+argument_stats_lock = threading.Lock()
+
+def _words(text):
+    return set(re.findall(r"\w+", str(text).lower()))
+
+def bind_arguments_locally(sub_question, table_data, function_args):
+    """
+    Bind each argument to the one table cell value that appears verbatim in the
+    sub-question, looking only at columns whose header shares a word with the
+    argument name. Returns None unless every argument has exactly one such value
+    """
+    question = sub_question.lower()
+    header_words = [_words(name) for name in table_data["header"]]
+    arguments = {}
+    for arg in function_args:
+        arg_words = set(re.split(r"[_\W]+", arg.lower())) - {""}
+        columns = [j for j, words in enumerate(header_words) if arg_words & words]
+        if not columns:
+            return None
+        matches = set()
+        for row in table_data["rows"]:
+            for j in columns:
+                value = str(row[j]).strip() if j < len(row) else ""
+                if value and re.search(r"(?<!\w)" + re.escape(value.lower()) + r"(?!\w)", question):
+                    matches.add(value)
+        # A value contained in a longer match (e.g. "2019" in "2019 Cup") is not a separate candidate
+        matches = {value for value in matches if not any(value != other and value.lower() in other.lower() for other in matches)}
+        if len(matches) != 1:
+            return None
+        arguments[arg] = matches.pop()
+    return arguments
+
+def bind_arguments(sub_question, table_data, function, function_args, model, state=None):
+    key = (sub_question, tuple(function_args))
+    if state is not None and key in state.argument_cache:
+        source = "cached"
+        arguments = state.argument_cache[key]
+    else:
+        source = "local"
+        arguments = bind_arguments_locally(sub_question, table_data, function_args)
+        if arguments is None:
+            source = "llm"
+            messages = [{"role": "user", "content": sub_question}]
+            function_response = get_function_completion(messages, functions=function, model=model)
+            if function_response is None:
+                return None
+            arguments = json.loads(function_response.function.arguments)
+        if state is not None:
+            with state.lock:
+                state.argument_cache[key] = arguments
+    with argument_stats_lock:
+        argument_stats[source] += 1
+    return arguments
+
+@traced
+def execute_function_call(sub_question, table_data, function_extract_response, model, state=None):
     success = False
     result = None
     feedback = None
@@ -69,36 +200,72 @@ def execute_function_call(sub_question, table_data, function_extract_response, m
     if function:
         arguments = {}
         if function_args != []:
-            messages = [{"role": "user", "content": sub_question}]
-            function_response = get_function_completion(messages, functions=function, model=model)
-            arguments = json.loads(function_response.function.arguments)
+            arguments = bind_arguments(sub_question, table_data, function, function_args, model, state)
+            if arguments is None:
+                return success, result, "Feedback: could not determine the function arguments from the question."
+        success, result, feedback = run_function(function_name, function_extract_response, function_args, table_data, arguments)
+    return success, result, feedback
+
+def run_function(function_name, function_string, function_args, table_data, arguments):
+    success = False
+    result = None
+    try:
+        args = [table_data] + [arguments[i] for i in function_args]
+        if sandbox.pool is not None:
+            success, result, error = sandbox.pool.run(function_name, function_string, args)
+            if not success:
+                raise RuntimeError(error)
         else:
-            function_response = None
-        try:
-            function_ref = create_function_from_string(function_name, function_extract_response)
-            args = [table_data] + [arguments[i] for i in function_args]
+            function_ref = create_function_from_string(function_name, function_string)
             result = function_ref(*args)
-            feedback = "Feedback: the python script is correct, nothing to fix."
-            success = True
-            # print("execute_function_call success, the result is:", result)
-        except Exception as e:
-            feedback = f"Feedback: {e}"
-            # print("execute_function_call error:", e)
+        feedback = "Feedback: the python script is correct, nothing to fix."
+        success = True
+        # print("execute_function_call success, the result is:", result)
+    except Exception as e:
+        feedback = f"Feedback: {e}"
+        # print("execute_function_call error:", e)
     return success, result, feedback
 
-def function_call(log_data, sub_question, table_data, function_extract_response, model):
-    success, result, feedback = execute_function_call(sub_question, table_data, function_extract_response, model)
+NO_ANSWER = {"", "none", "n/a", "na", "unknown", "not found", "no answer", "not available", "not mentioned"}
+
+def answer_directly(sub_question, table_data, model):
+    """
+    ask_directly, with a map-reduce path for tables that exceed the context budget:
+    each row chunk is asked in parallel and the partial answers are merged
+    """
+    if not table_compaction.is_oversized(table_data):
+        return ask_directly(sub_question, table_data, model)
+    chunks = table_compaction.chunk_table(table_data)
+    with ThreadPoolExecutor(max_workers=min(len(chunks), 8)) as executor:
+        partial_answers = list(executor.map(in_current_context(lambda chunk: ask_directly(sub_question, chunk, model)), chunks))
+    return merge_partial_answers(partial_answers)
+
+def merge_partial_answers(partial_answers):
+    merged = []
+    for answer in partial_answers:
+        answer = (answer or "").strip()
+        if answer.strip(" .").lower() not in NO_ANSWER and answer not in merged:
+            merged.append(answer)
+    return "; ".join(merged) if merged else "None"
+
+@traced
+def function_call(log_data, sub_question, table_data, function_extract_response, model, state=None):
+    success, result, feedback = execute_function_call(sub_question, table_data, function_extract_response, model, state)
     iter_num = 0
     while(not success and iter_num < 3):
+        reason = budget.exhausted()
+        if reason is not None:
+            log_data["degraded"] = {"action": "skip_self_debugging", "reason": reason}
+            break
         iter_num += 1
         function_extract_response = self_debugging(sub_question, table_data, function_extract_response, feedback, model)
-        success, result, feedback = execute_function_call(sub_question, table_data, function_extract_response, model)
+        success, result, feedback = execute_function_call(sub_question, table_data, function_extract_response, model, state)
         log_data["function"].append(function_extract_response)
         if success:
             break
     if result == None or result == "None":
         # print("can not find answer by function call!")
-        result = ask_directly(sub_question, table_data, model)
+        result = answer_directly(sub_question, table_data, model)
 
     # print("="*100)
     # print(f"Function Call")
@@ -107,161 +274,387 @@ def function_call(log_data, sub_question, table_data, function_extract_response,
 
     return result
 
-def process_sub_question(sub_question, table_data, model):
+@traced
+def process_sub_question(sub_question, table_data, model, state=None, generate_sentence=True):
     # print("="*100)
     # print(f"Process Sub Question")
     # print("-"*100)
     # print(f"Sub Question: {sub_question}")
 
+    if state is None:
+        state = ExampleState()
+    key = f"sq/{normalize_question(sub_question)}"
     log_data = {}
-    function_response = function_generator(sub_question, table_data, model)
-    function_extract_response = function_extraction(function_response, model)
+    reason = None if state.has_checkpoint(key + "/short_answer") else budget.exhausted()
+    if reason is not None:
+        # Out of budget: one direct question instead of generating and running a program
+        log_data.update(state.checkpointed(key + "/short_answer", lambda: {
+            "function": [],
+            "short_answer": answer_directly(sub_question, table_data, model),
+            "degraded": {"action": "ask_directly", "reason": reason},
+        }))
+    else:
+        function_extract_response = state.checkpointed(key + "/function", lambda: function_extraction(function_generator(sub_question, table_data, model), model))
 
-    # print("="*100)
-    # print(f"Function Extraction")
-    # print("-"*100)
-    # print(f"Function Extract Response: {function_extract_response}")
+        # print("="*100)
+        # print(f"Function Extraction")
+        # print("-"*100)
+        # print(f"Function Extract Response: {function_extract_response}")
 
-    log_data["function"] = [function_extract_response]
-    short_answer = function_call(log_data, sub_question, table_data, function_extract_response, model)
-    long_answer = sentence_generator(short_answer, sub_question, model)
-    log_data["short_answer"] = short_answer
-    log_data["long_answer"] = long_answer
+        def solve():
+            function_log = {"function": [function_extract_response]}
+            short_answer = function_call(function_log, sub_question, table_data, function_extract_response, model, state)
+            return dict(function_log, short_answer=short_answer)
+        log_data.update(state.checkpointed(key + "/short_answer", solve))
+    short_answer = log_data["short_answer"]
+    long_answer = None
+    if generate_sentence:
+        long_answer = state.checkpointed(key + "/long_answer", lambda: sentence_generator(short_answer, sub_question, model))
+        log_data["long_answer"] = long_answer
 
     return long_answer, log_data
 
-def get_table_answer(test_data, done_samples, n_samples, model, output_path, dataset_name):
-    # Ensure output directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
-    # Open file in append mode to continue writing without overwriting existing data
-    with open(output_path, "a", encoding="utf-8") as f:
-        i = 0
-        for item in test_data:
-            example_id = item["example_id"]
-            query = item["query"]
-            if example_id in done_samples.keys():
-                continue
-            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Processing #{i}...")
-            i += 1
-            try:
-                table_data = item["table"]
-                ground_truth = item["summary"]
-                iter_num = 0
-                log_data = []
-                prediction = "error"
-                old_plan = None
-                while(True):
-                    iter_num += 1
-                    iter_data = {"iter_num": iter_num}
-                    question_list = plan_generation(query, old_plan, model)
-                    old_plan = question_list
-                    iter_data["plan"] = question_list
-                    answer_list = []
-                    sub_log_list = []
-                    for sub_question in question_list:
-                        sub_answer, sub_log_data = process_sub_question(sub_question, table_data, model)
-                        answer_list.append(sub_answer)
-                        sub_log_list.append(sub_log_data)
-                    iter_data["reasoning_log"] = sub_log_list
-                    log_data.append(iter_data)
-                    done = check_plan(query, question_list, model)
-                    if done or iter_num >= 3:
-                        if dataset_name == "FeTaQA":
-                            prediction = generate_final_answer_fetaqa(query, answer_list, model)
-                        elif dataset_name == "QTSumm":
-                            prediction = generate_final_answer_qtsumm(query, answer_list, model)
-                        break
-                result_item = {"example_id": example_id, "query": query, "prediction": prediction, "ground_truth": ground_truth, "log_data": json_serialize_safe(log_data)}
-                # print("-"*100)
-                # print("Ground Truth:", ground_truth)
-            except Exception as e:
-                result_item = {"example_id": example_id, "query": query, "prediction": "error"}
-            
-            # Write current result immediately
-            f.write(json.dumps(result_item, ensure_ascii=False) + "\n")
-            f.flush()  # Force flush buffer to ensure data is written to disk immediately
-            print(f"✓ Result written: {example_id}")
-            
-            if n_samples != -1 and i >= n_samples:
-                break
+def generate_sentences(question_list, answers, model, state=None):
+    """
+    Fill in the long answers of sub-questions processed without a sentence, using one
+    batched request and falling back to per-item sentence_generator calls if it does not parse.
+    Long answers already checkpointed by an earlier run are reused instead of requested again
+    """
+    keys = [f"sq/{normalize_question(sub_question)}/long_answer" for sub_question in question_list]
+    sentences = [state.get_checkpoint(key) if state is not None else None for key in keys]
+    missing = [i for i, key in enumerate(keys) if state is None or not state.has_checkpoint(key)]
+    items = [(question_list[i], answers[i][1]["short_answer"]) for i in missing]
+    new_sentences = sentence_generator_batch(items, model) if len(items) > 1 else None
+    if new_sentences is None:
+        new_sentences = [sentence_generator(short_answer, sub_question, model) for sub_question, short_answer in items]
+    for i, sentence in zip(missing, new_sentences):
+        sentences[i] = state.checkpointed(keys[i], lambda sentence=sentence: sentence) if state is not None else sentence
+    results = []
+    for long_answer, (_, log_data) in zip(sentences, answers):
+        log_data["long_answer"] = long_answer
+        results.append((long_answer, log_data))
+    return results
 
-def clean_error_entries(output_path):
+def map_sub_questions(question_list, table_data, model, concurrency=1, state=None, iter_num=None, batch_sentences=False):
     """
-    Clean error entries from output file, keeping only successful results
+    Answer every sub-question of a plan, dispatching up to `concurrency` of them at once.
+    Sub-questions already answered in an earlier plan iteration of the example are reused.
+    With batch_sentences, the sentences of all new sub-questions come from a single request.
+    Results come back in plan order
     """
-    if not os.path.exists(output_path):
-        return {}, 0, 0
-    
-    print(f"Cleaning error entries from file: {output_path}")
-    
-    # Read all data
-    all_items = []
-    with open(output_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                item = json.loads(line)
-                all_items.append(item)
-    
-    # Filter out error entries and count statistics
-    valid_items = []
-    done_samples = {}
-    error_count = 0
-    success_count = 0
-    
-    for item in all_items:
-        if item["prediction"] != "error":
-            valid_items.append(item)
-            done_samples[item["example_id"]] = item
-            success_count += 1
+    results = [None] * len(question_list)
+    pending = []
+    for i, sub_question in enumerate(question_list):
+        reused = state.lookup_sub_question(sub_question) if state is not None else None
+        if reused is not None:
+            long_answer, log_data, from_iter = reused
+            results[i] = (long_answer, dict(log_data, reused_from_iter=from_iter))
         else:
-            error_count += 1
-    
-    # Rewrite file with only successful entries
-    with open(output_path, "w", encoding="utf-8") as f:
-        for item in valid_items:
-            f.write(json.dumps(item, ensure_ascii=False) + "\n")
-    
-    print(f"✓ Cleanup completed: kept {success_count} successful items, removed {error_count} error items")
-    return done_samples, success_count, error_count
+            pending.append(i)
 
-if __name__ == "__main__":
+    def process(i):
+        return process_sub_question(question_list[i], table_data, model, state, generate_sentence=not batch_sentences)
+
+    if concurrency <= 1 or len(pending) <= 1:
+        answers = [process(i) for i in pending]
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(pending))) as executor:
+            answers = list(executor.map(in_current_context(process), pending))
+    if batch_sentences and pending:
+        answers = generate_sentences([question_list[i] for i in pending], answers, model, state)
+    for i, (long_answer, log_data) in zip(pending, answers):
+        results[i] = (long_answer, log_data)
+        if state is not None:
+            state.store_sub_question(question_list[i], long_answer, log_data, iter_num)
+    return results
+
+def check_and_replan(query, question_list, iter_num, model, planner, state):
+    """
+    check_plan for the pipelined mode; when the plan is rejected and another iteration
+    will follow, the improved plan is requested right away on `planner`.
+    The verdict is checkpointed as soon as it arrives, so a retried example does not ask again
+    """
+    done = state.checkpointed(f"iter{iter_num}/check", lambda: check_plan(query, question_list, model))
+    next_plan = None
+    # Speculative, so only sent while the budgets still allow another iteration
+    if not done and iter_num < 3 and budget.exhausted() is None:
+        next_plan = planner.submit(in_current_context(plan_generation), query, question_list, model)
+    return done, next_plan
+
+def process_example(item, model, dataset_name, sub_question_concurrency=1, pipeline_plan_check=False, batch_sentences=False, checkpoint_dir=None):
+    start = time.monotonic()
+    with record_calls() as llm_calls, budget.example_budget(), tracing.example_track(f"example {item['example_id']}"), tracing.span("process_example", example_id=item["example_id"]):
+        result_item = solve_example(item, model, dataset_name, sub_question_concurrency, pipeline_plan_check, batch_sentences, checkpoint_dir)
+    result_item["llm_calls"] = llm_calls
+    result_item["elapsed"] = round(time.monotonic() - start, 3)
+    return result_item
+
+def solve_example(item, model, dataset_name, sub_question_concurrency=1, pipeline_plan_check=False, batch_sentences=False, checkpoint_dir=None):
+    example_id = item["example_id"]
+    query = item["query"]
+    # check_plan only needs the plan, so in pipelined mode it runs alongside the sub-questions
+    planner = ThreadPoolExecutor(max_workers=2) if pipeline_plan_check else None
+    try:
+        table_data = item["table"]
+        ground_truth = item["summary"]
+        iter_num = 0
+        log_data = []
+        prediction = "error"
+        old_plan = None
+        next_plan = None
+        state = ExampleState(get_checkpoint_path(checkpoint_dir, example_id) if checkpoint_dir else None)
+        while(True):
+            iter_num += 1
+            iter_data = {"iter_num": iter_num}
+            if next_plan is not None:
+                question_list = state.checkpointed(f"iter{iter_num}/plan", next_plan.result)
+            else:
+                question_list = state.checkpointed(f"iter{iter_num}/plan", lambda: plan_generation(query, old_plan, model))
+            old_plan = question_list
+            iter_data["plan"] = question_list
+            check_future = None
+            if planner is not None and not state.has_checkpoint(f"iter{iter_num}/check"):
+                check_future = planner.submit(in_current_context(check_and_replan), query, question_list, iter_num, model, planner, state)
+            answer_list = []
+            sub_log_list = []
+            for sub_answer, sub_log_data in map_sub_questions(question_list, table_data, model, sub_question_concurrency, state, iter_num, batch_sentences):
+                answer_list.append(sub_answer)
+                sub_log_list.append(sub_log_data)
+            iter_data["reasoning_log"] = sub_log_list
+            log_data.append(iter_data)
+            reason = None
+            if check_future is not None:
+                done, next_plan = check_future.result()
+            else:
+                if iter_num < 3 and not state.has_checkpoint(f"iter{iter_num}/check"):
+                    reason = budget.exhausted()
+                done = reason is None and state.checkpointed(f"iter{iter_num}/check", lambda: check_plan(query, question_list, model))
+            if not done and iter_num < 3:
+                reason = reason or budget.exhausted()
+                if reason is not None:
+                    # Out of budget: no further plan iterations, answer with the current sub-answers
+                    iter_data["degraded"] = {"action": "finalize", "reason": reason}
+                    done = True
+            if done or iter_num >= 3:
+                if dataset_name == "FeTaQA":
+                    prediction = state.checkpointed("final_answer", lambda: generate_final_answer_fetaqa(query, answer_list, model))
+                elif dataset_name == "QTSumm":
+                    prediction = state.checkpointed("final_answer", lambda: generate_final_answer_qtsumm(query, answer_list, model))
+                break
+        result_item = {"example_id": example_id, "query": query, "prediction": prediction, "ground_truth": ground_truth, "log_data": json_serialize_safe(log_data)}
+        # print("-"*100)
+        # print("Ground Truth:", ground_truth)
+    except Exception as e:
+        result_item = {"example_id": example_id, "query": query, "prediction": "error"}
+    finally:
+        if planner is not None:
+            planner.shutdown(wait=False)
+    return result_item
+
+def run_bounded(fn, items, concurrency):
+    """
+    Run fn over items on a thread pool with at most `concurrency` calls in flight,
+    yielding (index, result) pairs in completion order
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+        items = iter(enumerate(items))
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < concurrency:
+                try:
+                    index, item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight[executor.submit(fn, item)] = index
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield in_flight.pop(future), future.result()
+
+def get_table_answer(test_data, done_samples, n_samples, model, output_path, dataset_name, concurrency=1, ordered=False, sub_question_concurrency=1, pipeline_plan_check=False, batch_sentences=False, checkpoint_dir=None, trace_store_path=None):
+    # Ensure output directory exists
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    pending = (item for item in test_data if item["example_id"] not in done_samples)
+    if n_samples != -1:
+        pending = itertools.islice(pending, n_samples)
+    # Once the run budget is spent, examples in flight finish degraded and no new ones are started
+    pending = itertools.takewhile(lambda item: budget.run_budget.exceeded() is None, pending)
+
+    def process(indexed_item):
+        i, item = indexed_item
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Processing #{i}...")
+        return process_example(item, model, dataset_name, sub_question_concurrency, pipeline_plan_check, batch_sentences, checkpoint_dir)
+
+    # Results are only ever appended; a retried example supersedes its earlier error entry.
+    # With a trace store, log_data goes there and the output keeps only the slim result
+    with OutputStore(output_path) as store, (TraceStore(trace_store_path) if trace_store_path else nullcontext()) as trace_store:
+        def write_result(result_item):
+            if trace_store is not None and "log_data" in result_item:
+                # The trace is stored first, so no result ever points at a missing trace
+                trace_store.put(result_item["example_id"], result_item.pop("log_data"))
+            # Write current result immediately
+            store.append(result_item)
+            print(f"✓ Result written: {result_item['example_id']}")
+            # Intermediate stages are only kept for examples that still have to be retried
+            if checkpoint_dir and result_item["prediction"] != "error":
+                checkpoint_path = get_checkpoint_path(checkpoint_dir, result_item["example_id"])
+                if os.path.exists(checkpoint_path):
+                    os.remove(checkpoint_path)
+
+        if concurrency <= 1:
+            for indexed_item in enumerate(pending):
+                write_result(process(indexed_item))
+            return
+
+        # Keep `concurrency` examples in flight; with `ordered`, finished results are
+        # held back until every earlier example has been written
+        buffered = {}
+        next_index = 0
+        for index, result_item in run_bounded(process, enumerate(pending), concurrency):
+            if not ordered:
+                write_result(result_item)
+                continue
+            buffered[index] = result_item
+            while next_index in buffered:
+                write_result(buffered.pop(next_index))
+                next_index += 1
+
+def load_test_data(dataset_name, split_name, cache_dir=DEFAULT_CACHE_DIR):
+    return load_unified(dataset_name, split_name, cache_dir)
+
+def build_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", type=str, default="gpt-35-turbo")
     parser.add_argument("--n_samples", type=int, default=10) # -1 for all samples
     parser.add_argument("--dataset_name", type=str, default="yale-nlp/QTSumm")
     parser.add_argument("--split_name", type=str, default="test")
     parser.add_argument("--output_path", type=str, default="outputs")
+    parser.add_argument("--dataset_cache_dir", type=str, default=DEFAULT_CACHE_DIR) # preprocessed Arrow copies of the dataset splits
+    parser.add_argument("--num_shards", type=int, default=1) # split the examples over this many independent runs
+    parser.add_argument("--shard_index", type=int, default=0) # shard processed by this run, 0 <= shard_index < num_shards
+    parser.add_argument("--concurrency", type=int, default=1) # number of examples processed in parallel
+    parser.add_argument("--ordered", action="store_true") # write results in dataset order when concurrency > 1
+    parser.add_argument("--sub_question_concurrency", type=int, default=1) # sub-questions of a plan answered in parallel
+    parser.add_argument("--pipeline_plan_check", action="store_true") # run check_plan (and the next plan) alongside sub-questions
+    parser.add_argument("--batch_sentences", action="store_true") # one sentence_generator request per plan instead of per sub-question
+    parser.add_argument("--separate_log_data", action="store_true") # write log_data to <output file>.log_data.sqlite instead of the output JSONL
+    parser.add_argument("--no_checkpoints", action="store_true") # do not persist per-example intermediate stages
+    parser.add_argument("--api_base_url", type=str, default=None) # OpenAI-compatible server to use instead of the environment's, e.g. mock_server.py
+    parser.add_argument("--stage_models", type=str, default=None) # per-stage models overriding --model, e.g. check_plan=gpt-4o-mini,function_extraction=gpt-4o-mini
+    parser.add_argument("--endpoints", type=str, default=None) # OpenAI-compatible base URLs to balance over, optionally per model: url1,url2,model=url3
+    parser.add_argument("--health_check_interval", type=float, default=30.0) # seconds between endpoint health probes
+    parser.add_argument("--cache_path", type=str, default=None) # SQLite file caching LLM responses across runs
+    parser.add_argument("--cache_mode", type=str, default="readwrite", choices=["readwrite", "replay"]) # replay never calls the API
+    parser.add_argument("--cache_max_entries", type=int, default=None)
+    parser.add_argument("--cache_max_age_days", type=float, default=None)
+    parser.add_argument("--rpm", type=int, default=None) # requests-per-minute budget, unlimited by default
+    parser.add_argument("--tpm", type=int, default=None) # tokens-per-minute budget, unlimited by default
+    parser.add_argument("--max_retries", type=int, default=6) # retries for 429/5xx/connection errors
+    parser.add_argument("--table_strategy", type=str, default="full", choices=list(table_compaction.STRATEGIES)) # rows shown in table prompts
+    parser.add_argument("--table_encoding", type=str, default="repr", choices=list(table_compaction.ENCODINGS))
+    parser.add_argument("--table_max_rows", type=int, default=20) # rows kept by the sample/relevance strategies
+    parser.add_argument("--table_prune_columns", action="store_true") # drop irrelevant columns (only ask_directly)
+    parser.add_argument("--table_stages", type=str, default=",".join(table_compaction.STAGES)) # stages the table options apply to
+    parser.add_argument("--max_table_tokens", type=int, default=8000) # larger tables are chunked; -1 disables the check
+    parser.add_argument("--sandbox_workers", type=int, default=0) # worker processes for generated functions; 0 runs them in-process
+    parser.add_argument("--sandbox_timeout", type=float, default=10.0) # seconds per generated function call
+    parser.add_argument("--sandbox_memory_mb", type=int, default=1024) # memory limit per worker process
+    parser.add_argument("--max_calls_per_example", type=int, default=None) # LLM call budget of one example
+    parser.add_argument("--max_tokens_per_example", type=int, default=None) # prompt + completion token budget of one example
+    parser.add_argument("--max_seconds_per_example", type=float, default=None) # wall time budget of one example
+    parser.add_argument("--max_run_calls", type=int, default=None) # LLM call budget of the whole run
+    parser.add_argument("--max_run_tokens", type=int, default=None) # token budget of the whole run
+    parser.add_argument("--max_run_seconds", type=float, default=None) # wall time budget of the whole run
+    parser.add_argument("--trace_path", type=str, default=None) # write a Chrome trace of the run (open in Perfetto)
+    return parser
+
+def configure_pipeline(args):
+    if args.sandbox_workers > 0:
+        sandbox.configure_sandbox(args.sandbox_workers, args.sandbox_timeout, args.sandbox_memory_mb)
+    table_compaction.configure_max_table_tokens(None if args.max_table_tokens == -1 else args.max_table_tokens)
+    for stage in args.table_stages.split(","):
+        table_compaction.configure_compaction(stage, args.table_strategy, args.table_encoding, args.table_max_rows, args.table_prune_columns)
+    if args.api_base_url:
+        openai_utils.configure_client(args.api_base_url)
+    if args.stage_models:
+        openai_utils.configure_stage_models(dict(entry.split("=", 1) for entry in args.stage_models.split(",")))
+    if args.endpoints:
+        endpoints = []
+        for entry in args.endpoints.split(","):
+            model, _, base_url = entry.partition("=") if "=" in entry.split("://")[0] else ("", "", entry)
+            endpoints.append((model or None, base_url))
+        openai_utils.configure_endpoints(endpoints, health_interval=args.health_check_interval)
+    openai_utils.configure_scheduler(rpm=args.rpm, tpm=args.tpm, max_retries=args.max_retries)
+    if args.cache_path:
+        openai_utils.configure_cache(args.cache_path, args.cache_mode, args.cache_max_entries, args.cache_max_age_days)
+    if args.trace_path:
+        tracing.configure_tracing(args.trace_path)
+    budget.configure_budgets(args.max_calls_per_example, args.max_tokens_per_example, args.max_seconds_per_example,
+                             args.max_run_calls, args.max_run_tokens, args.max_run_seconds)
+
+def get_output_path(args, shard=True):
+    dataset_name = args.dataset_name.split("/")[-1]
+    output_path = os.path.join(args.output_path, f"{dataset_name}_output", f"{dataset_name}_{args.split_name}_{args.model}_output.jsonl")
+    if shard and args.num_shards > 1:
+        # Every shard writes (and resumes from) a file of its own
+        output_path = get_shard_path(output_path, args.shard_index, args.num_shards)
+    return output_path
+
+def select_test_data(test_data, args):
+    """
+    The examples this run is responsible for, and the n_samples limit left to apply to them
+    """
+    if args.num_shards <= 1:
+        return test_data, args.n_samples
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(f"--shard_index must be in [0, {args.num_shards})")
+    # n_samples selects the examples before sharding, so the shards add up to an unsharded run
+    return select_shard(test_data, args.num_shards, args.shard_index, args.n_samples), -1
+
+def print_run_stats():
+    print(f"Function extraction: {extraction_stats['local']} local, {extraction_stats['fallback']} LLM fallback")
+    print(f"Argument binding: {argument_stats['cached']} cached, {argument_stats['local']} local, {argument_stats['llm']} LLM")
+    if openai_utils.cache is not None:
+        print(f"LLM cache stats: {openai_utils.cache.stats()}")
+    for model, pool in openai_utils.pools.items():
+        print(f"Endpoint stats ({model or 'all models'}): {pool.stats()}")
+    run_budget = budget.run_budget
+    print(f"LLM requests sent: {run_budget.calls}, tokens: {run_budget.tokens}")
+    if run_budget.exceeded() is not None:
+        print(f"Run budget exhausted ({run_budget.exceeded()}); remaining samples were not started")
+    for stage, stats in table_compaction.compaction_report().items():
+        print(f"Table prompt tokens for {stage}: {stats['compacted_tokens']}/{stats['original_tokens']}, saved {stats['saved_per_call']:.1f} per call")
+
+if __name__ == "__main__":
+    parser = build_arg_parser()
     args = parser.parse_args()
     model = args.model
     dataset_name = args.dataset_name.split("/")[-1]
-    output_path = os.path.join(args.output_path, f"{dataset_name}_output", f"{dataset_name}_{args.split_name}_{model}_output.jsonl")
+    output_path = get_output_path(args)
     
-    # Clean error entries and get completed samples
-    done_samples, success_count, error_count = clean_error_entries(output_path)
+    configure_pipeline(args)
+
+    # Completed samples, read from the output's index
+    done_samples, success_count, error_count = scan_output(output_path)
     
-    test_data = load_dataset(args.dataset_name, split=args.split_name) 
-    if dataset_name == "FeTaQA":
-        def transform_fetaqa_to_qtsumm(example):
-            table_dict = {
-                'header': example['table_array'][0],
-                'rows': example['table_array'][1:],
-                'title': f"{example['table_page_title']}, {example['table_section_title']}"
-            }
-            return {
-                'example_id': str(example['feta_id']),
-                'query': example['question'],
-                'summary': example['answer'],
-                'table': table_dict
-            }
-        test_data = test_data.map(
-            transform_fetaqa_to_qtsumm,
-            remove_columns=test_data.column_names
-        )
+    test_data, n_samples = select_test_data(load_test_data(args.dataset_name, args.split_name, args.dataset_cache_dir), args)
     
     print(f"Starting data processing, {success_count} samples completed, processing remaining samples...")
     
     # Process data and write in real-time
-    get_table_answer(test_data, done_samples, args.n_samples, model, output_path, dataset_name)
+    checkpoint_dir = None if args.no_checkpoints else output_path + ".checkpoints"
+    trace_store_path = get_trace_store_path(output_path) if args.separate_log_data else None
+    get_table_answer(test_data, done_samples, n_samples, model, output_path, dataset_name, args.concurrency, args.ordered, args.sub_question_concurrency, args.pipeline_plan_check, args.batch_sentences, checkpoint_dir, trace_store_path)
     print("✓ All data processing completed!")
+    if sandbox.pool is not None:
+        sandbox.pool.close()
+    print_run_stats()
+    if tracing.tracer is not None:
+        tracing.save()
+        print(f"Trace written to {args.trace_path}")
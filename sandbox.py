@@ -0,0 +1,135 @@
+import ast
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows; memory limits are skipped there
+    resource = None
+
+
+def _worker_main(conn, memory_mb):
+    '''
+    Loop of a sandbox worker: receive (function_name, function_string, args), run the
+    function and send back ("ok", result) or ("error", message)
+    '''
+    if resource is not None and memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    # Startup (e.g. importing the preloaded main module) must not count against the first call's timeout
+    conn.send("ready")
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        function_name, function_string, args = request
+        try:
+            # Modules the in-process executor exposed to generated code
+            namespace = {"re": re, "json": json, "ast": ast, "os": os, "time": time}
+            exec(function_string, namespace)
+            result = namespace[function_name](*args)
+            try:
+                pickle.dumps(result)
+            except Exception:
+                result = repr(result)
+            reply = ("ok", result)
+        except MemoryError:
+            reply = ("error", f"the function exceeded the memory limit of {memory_mb} MB")
+        except Exception as e:
+            reply = ("error", str(e))
+        try:
+            conn.send(reply)
+        except MemoryError:
+            conn.send(("error", f"the function exceeded the memory limit of {memory_mb} MB"))
+
+
+class SandboxPool:
+    '''
+    Pool of pre-started worker processes that run LLM-generated table functions.
+
+    Each call is bounded by a wall-clock timeout and a per-worker address-space limit.
+    Workers are reused between calls; a worker that times out or dies is replaced.
+    '''
+    def __init__(self, num_workers=4, timeout=10.0, memory_mb=1024):
+        methods = multiprocessing.get_all_start_methods()
+        # forkserver keeps replacement workers from inheriting locks held by pipeline threads
+        self.context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.idle = queue.Queue()
+        # Workers start in parallel, then each is waited for
+        for worker in [self._start() for _ in range(num_workers)]:
+            self.idle.put(self._wait_ready(worker))
+
+    def _start(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, args=(child_conn, self.memory_mb), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def _wait_ready(self, worker):
+        process, conn = worker
+        if conn.recv() != "ready":
+            raise RuntimeError("sandbox worker failed to start")
+        return worker
+
+    def _spawn(self):
+        return self._wait_ready(self._start())
+
+    def _replace(self, worker):
+        process, conn = worker
+        process.kill()
+        process.join()
+        conn.close()
+        return self._spawn()
+
+    def run(self, function_name, function_string, args):
+        '''
+        Returns (success, result, error message)
+        '''
+        worker = self.idle.get()
+        try:
+            process, conn = worker
+            conn.send((function_name, function_string, args))
+            if not conn.poll(self.timeout):
+                worker = self._replace(worker)
+                return False, None, f"the function did not finish within {self.timeout} seconds"
+            status, payload = conn.recv()
+        except (EOFError, OSError):
+            worker = self._replace(worker)
+            return False, None, f"the function crashed the worker process (memory limit {self.memory_mb} MB)"
+        finally:
+            self.idle.put(worker)
+        if status == "ok":
+            return True, payload, None
+        return False, None, payload
+
+    def close(self):
+        while not self.idle.empty():
+            process, conn = self.idle.get()
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+            conn.close()
+
+
+# Optional worker pool, enabled with configure_sandbox; None runs functions in-process
+pool = None
+
+def configure_sandbox(num_workers, timeout=10.0, memory_mb=1024):
+    global pool
+    pool = SandboxPool(num_workers=num_workers, timeout=timeout, memory_mb=memory_mb)
+    return pool
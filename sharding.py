@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import sys
+from output_store import OutputStore, get_index_path, read_results
+from trace_store import TraceStore, get_trace_store_path
+
+
+def shard_of(example_id, num_shards):
+    '''
+    Shard of an example: a stable hash of its id, the same on every machine and Python run
+    '''
+    digest = hashlib.sha1(str(example_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def get_shard_path(output_path, shard_index, num_shards):
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.shard{shard_index}-of-{num_shards}{ext}"
+
+
+def get_merge_manifest_path(output_path):
+    # Written next to a merged output, so a later merge knows it may replace it
+    return output_path + ".merge.json"
+
+
+def dataset_example_ids(test_data, n_samples=-1):
+    '''
+    Example ids of the first n_samples examples (-1: all), in dataset order
+    '''
+    if hasattr(test_data, "example_ids"):
+        example_ids = test_data.example_ids()
+    else:
+        example_ids = [str(item["example_id"]) for item in test_data]
+    return example_ids if n_samples == -1 else example_ids[:n_samples]
+
+
+def select_shard(test_data, num_shards, shard_index, n_samples=-1):
+    '''
+    Lazily yield the examples of one shard of the first n_samples examples of test_data.
+    All shards together cover exactly the examples an unsharded run over n_samples would
+    '''
+    for i, example_id in enumerate(dataset_example_ids(test_data, n_samples)):
+        if shard_of(example_id, num_shards) == shard_index:
+            yield test_data[i]
+
+
+def merge_shards(shard_paths, output_path, expected_ids, num_shards, force=False):
+    '''
+    Merge per-shard outputs into output_path in dataset order, keeping one entry per example
+    (a successful one when there is any, see output_store.read_results). Returns a report of missing, failed and stray examples.
+    An existing output_path that is not an earlier merge, e.g. an unsharded run, is only replaced with force
+    '''
+    if os.path.exists(output_path) and not os.path.exists(get_merge_manifest_path(output_path)) and not force:
+        raise FileExistsError(f"{output_path} exists and is not the result of an earlier merge")
+    expected = set(expected_ids)
+    merged = {}
+    stray = set()
+    for shard_index, shard_path in enumerate(shard_paths):
+        if not os.path.exists(shard_path):
+            print(f"Missing shard file: {shard_path}")
+            continue
+        for item in read_results(shard_path):
+            example_id = str(item["example_id"])
+            if example_id not in expected or shard_of(example_id, num_shards) != shard_index:
+                stray.add(example_id)
+                continue
+            merged[example_id] = item
+
+    tmp_path = output_path + ".merge"
+    for path in (tmp_path, get_index_path(tmp_path)):
+        if os.path.exists(path):
+            os.remove(path)
+    with OutputStore(tmp_path) as store:
+        for example_id in expected_ids:
+            if example_id in merged:
+                store.append(merged[example_id])
+    os.replace(tmp_path, output_path)
+    os.replace(get_index_path(tmp_path), get_index_path(output_path))
+    merge_trace_stores([get_trace_store_path(shard_path) for shard_path in shard_paths], get_trace_store_path(output_path), merged)
+    with open(get_merge_manifest_path(output_path), "w", encoding="utf-8") as f:
+        json.dump({"num_shards": num_shards, "shards": shard_paths}, f)
+    return {
+        "expected": len(expected_ids),
+        "written": len(merged),
+        "missing": [example_id for example_id in expected_ids if example_id not in merged],
+        "errors": [example_id for example_id in expected_ids if merged.get(example_id, {}).get("prediction") == "error"],
+        "stray": sorted(stray),
+    }
+
+
+def merge_trace_stores(store_paths, output_store_path, merged):
+    '''
+    Copy the traces of the merged examples from shard trace stores (--separate_log_data), if there are any
+    '''
+    if os.path.exists(output_store_path):
+        os.remove(output_store_path)  # traces of the output this merge replaces
+    store_paths = [path for path in store_paths if os.path.exists(path)]
+    if not store_paths:
+        return
+    with TraceStore(output_store_path) as output_store:
+        for store_path in store_paths:
+            with TraceStore(store_path) as store:
+                for example_id in store.example_ids():
+                    if example_id in merged:
+                        output_store.put(example_id, store.get(example_id))
+
+
+if __name__ == "__main__":
+    from run_llm import build_arg_parser, get_output_path, load_test_data
+
+    parser = build_arg_parser()
+    parser.add_argument("--allow_incomplete", action="store_true") # exit with status 0 even if examples are missing or failed
+    parser.add_argument("--force", action="store_true") # replace an existing output file that is not an earlier merge
+    args = parser.parse_args()
+    if args.num_shards <= 1:
+        parser.error("--num_shards must be greater than 1")
+
+    output_path = get_output_path(args, shard=False)
+    shard_paths = [get_shard_path(output_path, i, args.num_shards) for i in range(args.num_shards)]
+    expected_ids = dataset_example_ids(load_test_data(args.dataset_name, args.split_name, args.dataset_cache_dir), args.n_samples)
+    try:
+        report = merge_shards(shard_paths, output_path, expected_ids, args.num_shards, args.force)
+    except FileExistsError as e:
+        print(f"{e}; pass --force to replace it")
+        sys.exit(1)
+
+    print(f"Merged {report['written']}/{report['expected']} examples from {args.num_shards} shards into {output_path}")
+    if report["stray"]:
+        print(f"Ignored {len(report['stray'])} entries that do not belong to their shard or split: {report['stray'][:10]}")
+    if report["errors"]:
+        print(f"{len(report['errors'])} examples failed in every attempt: {report['errors'][:10]}")
+    if report["missing"]:
+        print(f"{len(report['missing'])} examples are missing: {report['missing'][:10]}")
+    complete = not report["missing"] and not report["errors"]
+    print("✓ Output is complete" if complete else "Re-run the affected shards to fill the gaps, then merge again")
+    sys.exit(0 if complete or args.allow_incomplete else 1)
@@ -0,0 +1,243 @@
+import csv
+import io
+import re
+import threading
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+# Stages whose prompts embed the table; each can use its own compaction settings
+STAGES = ("function_generator", "self_debugging", "ask_directly")
+DEFAULT_CONFIG = {"strategy": "full", "encoding": "repr", "max_rows": 20, "prune_columns": False}
+
+stage_config = {stage: dict(DEFAULT_CONFIG) for stage in STAGES}
+# Tables whose serialization exceeds this many tokens are split into chunks (None disables the check)
+max_table_tokens = 8000
+savings = {stage: {"calls": 0, "original_tokens": 0, "compacted_tokens": 0} for stage in STAGES}
+_lock = threading.Lock()
+
+
+def count_tokens(text):
+    '''
+    Local token count, using tiktoken when it is installed and ~4 characters per token otherwise
+    '''
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def configure_compaction(stage, strategy=None, encoding=None, max_rows=None, prune_columns=None):
+    if stage not in stage_config:
+        raise ValueError(f"Unknown stage: {stage}")
+    if strategy is not None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown table compaction strategy: {strategy}")
+        stage_config[stage]["strategy"] = strategy
+    if encoding is not None:
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown table encoding: {encoding}")
+        stage_config[stage]["encoding"] = encoding
+    if max_rows is not None:
+        stage_config[stage]["max_rows"] = max_rows
+    if prune_columns is not None:
+        stage_config[stage]["prune_columns"] = prune_columns
+
+
+def configure_max_table_tokens(max_tokens):
+    global max_table_tokens
+    max_table_tokens = max_tokens
+
+
+def is_oversized(table_data):
+    return max_table_tokens is not None and count_tokens(str(table_data)) > max_table_tokens
+
+
+def chunk_table(table_data, max_tokens=None):
+    '''
+    Split the rows of table_data into consecutive chunks whose serialization fits in
+    max_tokens; every chunk keeps the title and header
+    '''
+    max_tokens = max_tokens or max_table_tokens
+    overhead = count_tokens(str(dict(table_data, rows=[])))
+    budget = max(max_tokens - overhead, 1)
+    chunks = []
+    current, current_tokens = [], 0
+    for row in table_data["rows"]:
+        row_tokens = count_tokens(str(row)) + 1
+        if current and current_tokens + row_tokens > budget:
+            chunks.append(dict(table_data, rows=current))
+            current, current_tokens = [], 0
+        current.append(row)
+        current_tokens += row_tokens
+    if current or not chunks:
+        chunks.append(dict(table_data, rows=current))
+    return chunks
+
+
+def _fit(table):
+    # Keep only the rows that fit in the context budget
+    if is_oversized(table):
+        return chunk_table(table)[0]
+    return table
+
+
+def _words(text):
+    return set(re.findall(r"\w+", str(text).lower()))
+
+
+def _sample_indices(n_rows, max_rows):
+    if n_rows <= max_rows:
+        return list(range(n_rows))
+    step = n_rows / max_rows
+    return [int(i * step) for i in range(max_rows)]
+
+
+def full_table(table_data, question, max_rows, prune_columns):
+    return list(table_data["header"]), list(table_data["rows"])
+
+
+def sampled_table(table_data, question, max_rows, prune_columns):
+    '''
+    Header plus evenly spaced rows, so the sample keeps the spread of the full table
+    '''
+    rows = table_data["rows"]
+    return list(table_data["header"]), [rows[i] for i in _sample_indices(len(rows), max_rows)]
+
+
+def relevant_table(table_data, question, max_rows, prune_columns):
+    '''
+    Rows (and optionally columns) ranked by lexical overlap with the question.
+    Falls back to a sample when no row mentions any question word
+    '''
+    header = list(table_data["header"])
+    rows = table_data["rows"]
+    question_words = _words(question)
+    scores = [len(question_words & _words(" ".join(map(str, row)))) for row in rows]
+    ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+    if not ranked:
+        return sampled_table(table_data, question, max_rows, prune_columns)
+    kept_rows = [rows[i] for i in sorted(ranked[:max_rows])]
+    if not prune_columns:
+        return header, kept_rows
+    keep = [0]
+    for j, name in enumerate(header):
+        if j == 0:
+            continue
+        column_words = _words(name)
+        for row in kept_rows:
+            if j < len(row):
+                column_words |= _words(row[j])
+        if question_words & column_words:
+            keep.append(j)
+    return [header[j] for j in keep], [[row[j] for j in keep if j < len(row)] for row in kept_rows]
+
+
+STRATEGIES = {"full": full_table, "sample": sampled_table, "relevance": relevant_table}
+
+
+def encode_rows(header, rows, encoding):
+    if encoding == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+        return buffer.getvalue().rstrip("\n")
+    if encoding == "markdown":
+        lines = ["| " + " | ".join(map(str, header)) + " |", "|" + " --- |" * len(header)]
+        lines += ["| " + " | ".join(str(cell).replace("|", "\\|") for cell in row) + " |" for row in rows]
+        return "\n".join(lines)
+    return str(rows)
+
+
+def encode_table(table, encoding):
+    if encoding == "repr":
+        return str(table)
+    return f"Title: {table.get('title', '')}\n" + encode_rows(table["header"], table["rows"], encoding)
+
+
+ENCODINGS = ("repr", "csv", "markdown")
+
+
+def compact_table(table_data, question, strategy="full", max_rows=20, prune_columns=False):
+    '''
+    Returns a copy of table_data reduced by the given strategy
+    '''
+    header, rows = STRATEGIES[strategy](table_data, question, max_rows, prune_columns)
+    table = dict(table_data)
+    table["header"] = header
+    table["rows"] = rows
+    return table
+
+
+def _record(stage, original_text, compacted_text):
+    original_tokens = count_tokens(original_text)
+    compacted_tokens = original_tokens if compacted_text is original_text else count_tokens(compacted_text)
+    with _lock:
+        stats = savings[stage]
+        stats["calls"] += 1
+        stats["original_tokens"] += original_tokens
+        stats["compacted_tokens"] += compacted_tokens
+    return original_tokens - compacted_tokens
+
+
+def _render_table(stage, table_data, question, prune_columns):
+    config = stage_config[stage]
+    original_text = str(table_data)
+    if config["strategy"] == "full" and config["encoding"] == "repr" and not is_oversized(table_data):
+        _record(stage, original_text, original_text)
+        return original_text, len(table_data["rows"])
+    table = _fit(compact_table(table_data, question, config["strategy"], config["max_rows"], prune_columns))
+    text = encode_table(table, config["encoding"])
+    _record(stage, original_text, text)
+    return text, len(table["rows"])
+
+
+def render_table(stage, table_data, question):
+    '''
+    Serialize the whole table (title, header and rows) for the prompt of `stage`
+    '''
+    return _render_table(stage, table_data, question, stage_config[stage]["prune_columns"])[0]
+
+
+def render_table_columns(stage, table_data, question):
+    '''
+    Serialize the whole table like render_table, but compact only its rows and keep every
+    column, for prompts about code that indexes columns by position.
+    Returns the table text and the number of rows shown
+    '''
+    return _render_table(stage, table_data, question, prune_columns=False)
+
+
+def render_rows(stage, table_data, question):
+    '''
+    Serialize only the rows for the prompt of `stage`, keeping every column so that
+    positional indexing in generated code still matches the full table.
+    Returns the rows text and the number of rows shown
+    '''
+    config = stage_config[stage]
+    original_text = str(table_data["rows"])
+    if config["strategy"] == "full" and config["encoding"] == "repr" and not is_oversized(table_data):
+        _record(stage, original_text, original_text)
+        return original_text, len(table_data["rows"])
+    table = _fit(compact_table(table_data, question, config["strategy"], config["max_rows"], prune_columns=False))
+    if config["encoding"] == "repr":
+        text = str(table["rows"])
+    else:
+        # the header is shown separately in the prompt, drop it from the encoded block
+        text = encode_rows(table["header"], table["rows"], config["encoding"]).split("\n", 2 if config["encoding"] == "markdown" else 1)[-1]
+    _record(stage, original_text, text)
+    return text, len(table["rows"])
+
+
+def compaction_report():
+    report = {}
+    with _lock:
+        for stage, stats in savings.items():
+            if not stats["calls"]:
+                continue
+            saved = stats["original_tokens"] - stats["compacted_tokens"]
+            report[stage] = dict(stats, saved_tokens=saved, saved_per_call=saved / stats["calls"])
+    return report
@@ -4,65 +4,42 @@
 
 import argparse
 from transformers import TapasForSequenceClassification, TapasTokenizer
-import torch, json, tqdm, os
-from torch.utils.data import Dataset, DataLoader
+import torch, tqdm, os, time
+from torch.utils.data import Dataset, DataLoader, Sampler
 import pandas as pd
-from datasets import load_dataset
+from dataset_cache import load_unified, DEFAULT_CACHE_DIR
+from output_store import read_results
+
+# Padded tokens per length-bucketed batch
+DEFAULT_MAX_BATCH_TOKENS = 16384
 
 class MyData(Dataset):
     '''
     Dataset for loading table-text data
     '''
-    def __init__(self, file_name, dataset_name, split_name, tokenizer):
-        self.tokenizer = tokenizer           
-        self.Data = self.load_data(file_name, dataset_name, split_name)
+    def __init__(self, file_name, dataset_name, split_name, tokenizer, pad_to_max_length=False, dataset_cache_dir=DEFAULT_CACHE_DIR):
+        self.tokenizer = tokenizer
+        # Padding every example to max_length is the old behavior, kept for benchmarking against it
+        self.pad_to_max_length = pad_to_max_length
+        # Encodings kept by encode_all(), so length bucketing does not tokenize every example twice
+        self.encodings = None
+        self.Data = self.load_data(file_name, dataset_name, split_name, dataset_cache_dir)
         self.len = len(self.Data)
         
-    def load_data(self, file_name, dataset_name, split_name):
-        table_dict = {}
-        qtsumm_data = load_dataset(dataset_name, split = split_name)
-        if dataset_name == "DongfuJiang/FeTaQA":
-            def transform_fetaqa_to_qtsumm(example):
-                table_dict = {
-                    'header': example['table_array'][0],
-                    'rows': example['table_array'][1:],
-                    'title': f"{example['table_page_title']}, {example['table_section_title']}"
-                }
-                return {
-                    'example_id': str(example['feta_id']),
-                    'query': example['question'],
-                    'summary': example['answer'],
-                    'table': table_dict
-                }
-            qtsumm_data = qtsumm_data.map(
-                transform_fetaqa_to_qtsumm,
-                remove_columns=qtsumm_data.column_names
-            )
-        for example in qtsumm_data:
-            example_id = example["example_id"]
-            header = example["table"]["header"]
-            rows = example["table"]["rows"]
-            table_dict[example_id] = {"header": header, "rows": rows}
+    def load_data(self, file_name, dataset_name, split_name, dataset_cache_dir=DEFAULT_CACHE_DIR):
+        # Tables stay in the memory-mapped dataset cache and are looked up per example
+        self.dataset = load_unified(dataset_name, split_name, dataset_cache_dir)
             
-        # Read JSONL format file
-        data = []
-        with open(file_name, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    item = json.loads(line)
-                    data.append(item)
+        # Read JSONL format file, one entry per example
+        data = list(read_results(file_name))
         
         new_data = []
         for example in data:
-            example_id = example['example_id']
-            header = table_dict[example_id]['header']
-            rows = table_dict[example_id]['rows']
+            if example['example_id'] not in self.dataset:
+                raise KeyError(example['example_id'])
             new_data.append({
-                "example_id": example_id, 
+                "example_id": example['example_id'],
                 "prediction": example["prediction"],
-                "header": header,
-                "rows": rows
             })
         return new_data
 
@@ -72,28 +49,93 @@ class MyData(Dataset):
         return: a pandas table and the statement
         '''
         sent = data['prediction']
-        header = data['header']
-        rows = data['rows']
+        table = self.dataset.get(data['example_id'])['table']
+        header = table['header']
+        rows = table['rows']
         table = pd.DataFrame(rows, columns=header)
         table = table.astype(str)
         return table, sent
 
     def encode(self, table, sent):
+        # Batches are padded in collate() only up to their longest example
         return self.tokenizer(table=table, queries=sent,
                 truncation=True,
-                padding='max_length',
+                padding='max_length' if self.pad_to_max_length else False,
                 max_length=2048)
 
     def __getitem__(self, index):
+        if self.encodings is not None:
+            return self.encodings[index]
         table, sent = self.read_data(self.Data[index])
-        d = self.encode(table, sent)
-        for key, value in d.items():
-            d[key] = torch.LongTensor(value)
-        return d
+        return dict(self.encode(table, sent))
+
+    def collate(self, features):
+        '''
+        collate_fn padding a batch to its longest example; TapasTokenizer pads the 7 token type ids per token
+        '''
+        return self.tokenizer.pad(features, padding='longest', return_tensors='pt')
+
+    def encode_all(self, num_workers=1):
+        '''
+        Tokenize every example once, in num_workers DataLoader workers, and keep the encodings
+        '''
+        if self.encodings is None:
+            loader = DataLoader(self, batch_size=None, collate_fn=_keep, num_workers=num_workers)
+            self.encodings = list(tqdm.tqdm(loader, total=self.len, desc="Tokenizing"))
+
+    def lengths(self, num_workers=1):
+        '''
+        Encoded length of every example, for length bucketing
+        '''
+        self.encode_all(num_workers)
+        return [len(encoding['input_ids']) for encoding in self.encodings]
 
     def __len__(self):
         return self.len
 
+def _keep(example):
+    # collate_fn of encode_all(): examples are kept as they are, unbatched
+    return example
+
+
+class TokenBudgetBatchSampler(Sampler):
+    '''
+    Batch sampler grouping examples of similar encoded length, so little of a batch is padding.
+
+    Examples are sorted by length and cut into batches whose padded size (batch size times
+    longest example) stays within max_tokens, so short examples get large batches and
+    long ones small batches. A batch also has at most max_batch_size examples.
+    '''
+    def __init__(self, lengths, max_tokens, max_batch_size):
+        self.batches = []
+        batch = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            # Sorted ascending, so example i is the longest of the batch it joins
+            if batch and ((len(batch) + 1) * lengths[i] > max_tokens or len(batch) >= max_batch_size):
+                self.batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def make_dataloader(data, batch_size, max_batch_tokens, num_workers=1):
+    '''
+    Fixed-size batches in file order when max_batch_tokens is 0, otherwise length-bucketed batches within the token budget
+    '''
+    if max_batch_tokens and not data.pad_to_max_length:
+        # Measuring lengths tokenizes every example in the workers; batches then come from the kept encodings
+        batch_sampler = TokenBudgetBatchSampler(data.lengths(num_workers), max_batch_tokens, batch_size)
+        return DataLoader(data, batch_sampler=batch_sampler, collate_fn=data.collate)
+    return DataLoader(data, batch_size=batch_size, shuffle=False, collate_fn=data.collate, num_workers=num_workers)
+
+
 class TapasTest:
     def __init__(self, model_name):
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -129,9 +171,32 @@ class TapasTest:
 
 def unit_test(args):
     tapas = TapasTest("google/tapas-large-finetuned-tabfact")
-    data = MyData(args.test_file, args.dataset_name, args.split_name, tapas.tokenizer)
-    test_dataloader = DataLoader(data, batch_size=args.batch_size, shuffle=False, num_workers=1)
+    data = MyData(args.test_file, args.dataset_name, args.split_name, tapas.tokenizer, dataset_cache_dir=args.dataset_cache_dir)
+    test_dataloader = make_dataloader(data, args.batch_size, args.max_batch_tokens)
     results = tapas.test(test_dataloader)
+    print(results)
+
+
+def benchmark(args):
+    '''
+    Throughput of the old fixed-size, max_length-padded batching against dynamic padding with
+    length-bucketed batches, on the first benchmark_samples examples of the test file
+    '''
+    tapas = TapasTest("google/tapas-large-finetuned-tabfact")
+    configs = [
+        ("max_length padding, fixed batches", True, 0),
+        ("dynamic padding, fixed batches", False, 0),
+        ("dynamic padding, bucketed batches", False, args.max_batch_tokens),
+    ]
+    for name, pad_to_max_length, max_batch_tokens in configs:
+        data = MyData(args.test_file, args.dataset_name, args.split_name, tapas.tokenizer, pad_to_max_length, args.dataset_cache_dir)
+        data.Data = data.Data[:args.benchmark_samples]
+        data.len = len(data.Data)
+        # Length measurement is part of the cost of bucketing, so it is timed too
+        start = time.monotonic()
+        results = tapas.test(make_dataloader(data, args.batch_size, max_batch_tokens))
+        elapsed = time.monotonic() - start
+        print(f"{name:<36}{data.len / elapsed:>8.2f} examples/s  {elapsed:>8.1f}s  acc {results.get('acc')}")
 
 
 if __name__ == '__main__':
@@ -139,6 +204,13 @@ if __name__ == '__main__':
     parser.add_argument('--test_file', default="", type=str, required=True)
     parser.add_argument('--dataset_name', default="yale-nlp/QTSumm", type=str)
     parser.add_argument('--split_name', default="test", type=str)
-    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--dataset_cache_dir', default=DEFAULT_CACHE_DIR, type=str) # the --dataset_cache_dir of the run_llm.py run
+    parser.add_argument('--batch_size', type=int, default=32) # maximum examples per batch
+    parser.add_argument('--max_batch_tokens', type=int, default=DEFAULT_MAX_BATCH_TOKENS) # padded tokens per length-bucketed batch; 0 for fixed batches in file order
+    parser.add_argument('--benchmark', action='store_true') # compare throughput with the old max_length padding instead of evaluating
+    parser.add_argument('--benchmark_samples', type=int, default=128)
     opt = parser.parse_args()
-    unit_test(opt)
+    if opt.benchmark:
+        benchmark(opt)
+    else:
+        unit_test(opt)
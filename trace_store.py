@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+# Suffix of the trace store written next to an output file with --separate_log_data
+STORE_SUFFIX = ".log_data.sqlite"
+
+
+def get_trace_store_path(output_path):
+    return output_path + STORE_SUFFIX
+
+
+class TraceStore:
+    '''
+    SQLite store of per-example traces (log_data), zlib-compressed and keyed by example_id.
+
+    Lets the output JSONL hold only predictions, so reading it for evaluation does not
+    scale with how verbose the traces are. A retried example replaces its earlier trace.
+    '''
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS traces (example_id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self.conn.commit()
+
+    def put(self, example_id, log_data):
+        data = zlib.compress(json.dumps(log_data, ensure_ascii=False).encode("utf-8"))
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO traces (example_id, data) VALUES (?, ?)", (str(example_id), data))
+            self.conn.commit()
+
+    def get(self, example_id):
+        '''
+        The trace of one example, or None
+        '''
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM traces WHERE example_id = ?", (str(example_id),)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row is not None else None
+
+    def __contains__(self, example_id):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM traces WHERE example_id = ?", (str(example_id),)).fetchone() is not None
+
+    def example_ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT example_id FROM traces")]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_log_data(output_path, example_id):
+    '''
+    log_data of one example of an output file, wherever it was written: inline or in the trace store
+    '''
+    store_path = get_trace_store_path(output_path)
+    if os.path.exists(store_path):
+        with TraceStore(store_path) as store:
+            log_data = store.get(example_id)
+        if log_data is not None:
+            return log_data
+    from output_store import read_results
+    for item in read_results(output_path):
+        if str(item["example_id"]) == str(example_id):
+            return item.get("log_data")
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_file", type=str) # JSONL written by run_llm.py
+    parser.add_argument("example_id", type=str)
+    args = parser.parse_args()
+    log_data = load_log_data(args.output_file, args.example_id)
+    if log_data is None:
+        print(f"No log_data for example {args.example_id}")
+    else:
+        print(json.dumps(log_data, indent=2, ensure_ascii=False))
@@ -0,0 +1,121 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    '''
+    Collects Chrome trace events (https://ui.perfetto.dev opens the saved file).
+
+    Spans are complete ("X") events; each example gets its own process track, so its
+    worker threads, nested stages and queueing gaps line up under one heading.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.start = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+        self.named_threads = set()
+        self.track_ids = itertools.count(1)
+
+    def now(self):
+        return (time.perf_counter() - self.start) * 1e6
+
+    def add(self, name, cat, start_us, end_us, args=None):
+        pid = _track.get()
+        tid = threading.get_ident()
+        event = {"name": name, "cat": cat, "ph": "X", "ts": round(start_us, 1), "dur": round(end_us - start_us, 1), "pid": pid, "tid": tid}
+        if args:
+            event["args"] = args
+        with self.lock:
+            if (pid, tid) not in self.named_threads:
+                self.named_threads.add((pid, tid))
+                self.events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": threading.current_thread().name}})
+            self.events.append(event)
+
+    def new_track(self, label):
+        pid = next(self.track_ids)
+        with self.lock:
+            self.events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": label}})
+            self.events.append({"name": "process_sort_index", "ph": "M", "pid": pid, "tid": 0, "args": {"sort_index": pid}})
+        return pid
+
+    def save(self):
+        with self.lock:
+            events = list(self.events)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+        os.replace(tmp_path, self.path)
+
+
+# Optional tracer, enabled with configure_tracing; None makes every span a no-op
+tracer = None
+
+# pid of the track spans are drawn on; 0 is the run itself
+_track = contextvars.ContextVar("trace_track", default=0)
+
+def configure_tracing(path):
+    global tracer
+    tracer = Tracer(path)
+    return tracer
+
+def save():
+    if tracer is not None:
+        tracer.save()
+
+@contextmanager
+def span(name, cat="pipeline", **args):
+    if tracer is None:
+        yield
+        return
+    start = tracer.now()
+    try:
+        yield
+    finally:
+        tracer.add(name, cat, start, tracer.now(), args)
+
+def traced(fn=None, name=None, cat="pipeline"):
+    '''
+    Decorator recording every call of fn as a span
+    '''
+    if fn is None:
+        return functools.partial(traced, name=name, cat=cat)
+    span_name = name or fn.__name__
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if tracer is None:
+            return fn(*args, **kwargs)
+        with span(span_name, cat):
+            return fn(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def example_track(label):
+    '''
+    Draw the spans of this context (and of thread pool work submitted from it) on a track of their own
+    '''
+    if tracer is None:
+        yield
+        return
+    token = _track.set(tracer.new_track(label))
+    try:
+        yield
+    finally:
+        _track.reset(token)
+
+def queued_since(submitted_us):
+    '''
+    Record the time a task waited in a thread pool queue before a worker picked it up
+    '''
+    if tracer is not None and submitted_us is not None:
+        tracer.add("queued", "queue", submitted_us, tracer.now())
+
+def submit_time():
+    return tracer.now() if tracer is not None else None
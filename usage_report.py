@@ -0,0 +1,103 @@
+import argparse
+import json
+import math
+from collections import defaultdict
+
+# USD per 1M (prompt, completion) tokens; override or extend with --price
+PRICES = {
+    "gpt-35-turbo": (0.5, 1.5),
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4.1": (2.0, 8.0),
+    "gpt-4.1-mini": (0.4, 1.6),
+    "gpt-4.1-nano": (0.1, 0.4),
+}
+
+STAGE_ORDER = [
+    "plan_generation", "check_plan", "function_generator", "function_extraction", "argument_binding",
+    "self_debugging", "ask_directly", "sentence_generator", "final_answer",
+]
+
+
+def percentile(values, q):
+    '''
+    Nearest-rank percentile of a non-empty list
+    '''
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def load_calls(file_path):
+    '''
+    Yield every llm_calls entry of an output JSONL file
+    '''
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                for call in json.loads(line).get("llm_calls", []):
+                    yield call
+
+
+def summarize_calls(calls, prices=PRICES):
+    stages = defaultdict(lambda: {"calls": 0, "cached": 0, "errors": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "latencies": []})
+    unpriced = set()
+    for call in calls:
+        stats = stages[call.get("stage") or "unknown"]
+        stats["calls"] += 1
+        stats["cached"] += int(bool(call.get("cached")))
+        stats["errors"] += int(bool(call.get("error")))
+        stats["retries"] += call.get("retries", 0)
+        stats["prompt_tokens"] += call.get("prompt_tokens", 0)
+        stats["completion_tokens"] += call.get("completion_tokens", 0)
+        if not call.get("cached"):
+            stats["latencies"].append(call.get("latency", 0.0))
+        price = prices.get(call.get("model"))
+        if price is None:
+            unpriced.add(call.get("model"))
+        else:
+            stats["cost"] += (call.get("prompt_tokens", 0) * price[0] + call.get("completion_tokens", 0) * price[1]) / 1e6
+    summary = {}
+    for stage in sorted(stages, key=lambda name: (STAGE_ORDER.index(name) if name in STAGE_ORDER else len(STAGE_ORDER), name)):
+        stats = stages[stage]
+        latencies = stats.pop("latencies")
+        stats["p50_latency"] = percentile(latencies, 50) if latencies else 0.0
+        stats["p95_latency"] = percentile(latencies, 95) if latencies else 0.0
+        summary[stage] = stats
+    return summary, unpriced
+
+
+def print_summary(summary):
+    print(f"{'Stage':<22}{'Calls':>8}{'Cached':>8}{'Errors':>8}{'Retries':>9}{'p50 s':>9}{'p95 s':>9}{'Prompt tok':>13}{'Compl. tok':>12}{'Cost $':>10}")
+    total = defaultdict(float)
+    for stage, stats in summary.items():
+        print(f"{stage:<22}{stats['calls']:>8}{stats['cached']:>8}{stats['errors']:>8}{stats['retries']:>9}{stats['p50_latency']:>9.2f}{stats['p95_latency']:>9.2f}"
+              f"{stats['prompt_tokens']:>13}{stats['completion_tokens']:>12}{stats['cost']:>10.4f}")
+        for key in ("calls", "cached", "errors", "retries", "prompt_tokens", "completion_tokens", "cost"):
+            total[key] += stats[key]
+    print(f"{'Total':<22}{int(total['calls']):>8}{int(total['cached']):>8}{int(total['errors']):>8}{int(total['retries']):>9}{'':>9}{'':>9}"
+          f"{int(total['prompt_tokens']):>13}{int(total['completion_tokens']):>12}{total['cost']:>10.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_file", type=str) # JSONL written by run_llm.py
+    parser.add_argument("--price", type=str, action="append", default=[]) # model=prompt_usd_per_1m,completion_usd_per_1m
+    parser.add_argument("--json", action="store_true") # print the summary as JSON
+    args = parser.parse_args()
+
+    prices = dict(PRICES)
+    for price in args.price:
+        model, values = price.split("=", 1)
+        prompt_price, completion_price = values.split(",")
+        prices[model] = (float(prompt_price), float(completion_price))
+
+    summary, unpriced = summarize_calls(load_calls(args.output_file), prices)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+    if unpriced:
+        print(f"No price known for: {', '.join(sorted(str(model) for model in unpriced))} (use --price model=prompt,completion)")